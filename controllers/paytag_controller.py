@@ -1,15 +1,34 @@
 # -*- coding: utf-8 -*-
-from odoo import http, fields
+from odoo import http
 from odoo.http import request, Response
 import json
 import logging
+import threading
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 
+from ..models.paytag_metrics import REGISTRY, instrument_route
+from ..models.paytag_notifier import get_item_notifier
+from ..models.paytag_websocket import DEFAULT_REPLY_TIMEOUT_MS, PaytagQueueFull, PaytagUnknownMachine
+
 _logger = logging.getLogger(__name__)
 
+# A long-poll holds a synchronous HTTP worker for its whole wait: keep it short
+DEFAULT_POLL_TIMEOUT = 5
+MAX_POLL_TIMEOUT = 10
+# Command endpoints hold a worker while waiting for the device too
+MAX_REPLY_WAIT_MS = 10000
+# Serialized /api/paytag/items bodies kept per ETag
+ITEMS_CACHE_SIZE = 256
+
 
 class PaytagAPI(http.Controller):
 
+    # (dbname, etag) -> serialized body, least recently used first
+    _items_cache = OrderedDict()
+    _items_cache_lock = threading.Lock()
+
     # ------------- Helpers -------------
 
     def _cors_headers(self):
@@ -19,14 +38,71 @@ class PaytagAPI(http.Controller):
             "Access-Control-Allow-Headers": "Content-Type, Authorization",
         }
 
-    def _json(self, data, status=200):
+    def _json(self, data, status=200, headers=None):
+        return self._json_body(json.dumps(data, ensure_ascii=False), status=status, headers=headers)
+
+    def _json_body(self, body, status=200, headers=None):
         return Response(
-            json.dumps(data, ensure_ascii=False),
+            body,
             content_type="application/json; charset=utf-8",
             status=status,
-            headers=self._cors_headers(),
+            headers=dict(self._cors_headers(), **(headers or {})),
         )
 
+    def _queue_full(self):
+        """Answer sent when the machine cannot take more commands right now."""
+        return self._json(
+            {"success": False, "error": "Paytag command queue is full, retry later"},
+            status=503,
+            headers={"Retry-After": "1"},
+        )
+
+    def _unknown_machine(self, machine_ip):
+        """Answer sent for a machine that is not listed in ``paytag.machines``."""
+        return self._json(
+            {"success": False, "error": f"Unknown Paytag machine {machine_ip}"},
+            status=400,
+        )
+
+    def _machine_allowed(self, machine_ip):
+        """Whether commands may target ``machine_ip`` (None means the default machine)."""
+        if not machine_ip:
+            return True
+        return isinstance(machine_ip, str) and (
+            machine_ip in request.env["paytag.websocket.service"].sudo()._configured_machines()
+        )
+
+    def _machine_ip(self, data):
+        """Machine targeted by a request: explicit, else the one of its session."""
+        if data.get("machine_ip"):
+            return data["machine_ip"]
+        if data.get("session_id"):
+            try:
+                session = request.env["paytag.session"].sudo().browse(int(data["session_id"]))
+                return session.machine_ip or None
+            except Exception:
+                return None
+        return None
+
+    def _reply_wait_ms(self, data):
+        """How long a command endpoint should wait for the device's answer."""
+        wait_ms = data.get("wait_ms")
+        if wait_ms is None:
+            wait_ms = request.env["ir.config_parameter"].sudo().get_param(
+                "paytag.reply_timeout_ms", DEFAULT_REPLY_TIMEOUT_MS
+            )
+        try:
+            return min(max(0, int(wait_ms)), MAX_REPLY_WAIT_MS)
+        except (TypeError, ValueError):
+            return DEFAULT_REPLY_TIMEOUT_MS
+
+    def _device_result(self, reply, wait_ms):
+        """Fields describing the device's answer to a command."""
+        if not wait_ms:
+            # send_command only reports whether the command was queued
+            return {"device_reply": None, "device_timeout": False}
+        return {"device_reply": reply, "device_timeout": reply is None}
+
     # ------------- Health check -------------
 
     @http.route(
@@ -36,18 +112,46 @@ class PaytagAPI(http.Controller):
         methods=["GET", "OPTIONS"],
         csrf=False,
     )
+    @instrument_route("health")
     def health(self, **kwargs):
         if request.httprequest.method == "OPTIONS":
             return Response(status=200, headers=self._cors_headers())
 
+        state = request.env["paytag.websocket.service"].sudo().connection_state()
+        machines = state.get("machines", {})
         return self._json(
             {
                 "status": "ok",
                 "message": "Paytag integration is installed",
                 "time": datetime.utcnow().isoformat() + "Z",
+                "service_running": bool(state.get("running")),
+                "machines_connected": sum(1 for machine in machines.values() if machine.get("connected")),
+                "machines": machines,
             }
         )
 
+    # ------------- Metrics -------------
+
+    @http.route(
+        "/api/paytag/metrics",
+        type="http",
+        auth="none",
+        methods=["GET"],
+        csrf=False,
+    )
+    def metrics(self, **kwargs):
+        """
+        Metrics of this Odoo process in the Prometheus text format, with the
+        websocket and ingestion ones of the leader process when it runs
+        elsewhere.
+        """
+        snapshot = request.env["paytag.websocket.service"].sudo().leader_metrics()
+        return Response(
+            REGISTRY.render(snapshot),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+            status=200,
+        )
+
     # ------------- Start session -------------
 
     @http.route(
@@ -57,6 +161,7 @@ class PaytagAPI(http.Controller):
         methods=["POST", "OPTIONS"],
         csrf=False,
     )
+    @instrument_route("start")
     def start_session(self, **kwargs):
         if request.httprequest.method == "OPTIONS":
             return Response(status=200, headers=self._cors_headers())
@@ -69,7 +174,7 @@ class PaytagAPI(http.Controller):
 
         transaction_number = (
             data.get("transaction_number")
-            or f"tx-{int(datetime.now().timestamp())}"
+            or f"tx-{uuid.uuid4().hex}"
         )
         request_code = data.get("request_code") or transaction_number
         version = data.get("version") or "odoo-paytag-1.0"
@@ -77,6 +182,9 @@ class PaytagAPI(http.Controller):
         # Ensure WebSocket service is running
         ws_service = request.env["paytag.websocket.service"].sudo()
         ws_service.ensure_running()
+        machine_ip = data.get("machine_ip") or ws_service._default_machine_ip()
+        if not self._machine_allowed(machine_ip):
+            return self._unknown_machine(machine_ip)
 
         # Create a new session record
         session = request.env["paytag.session"].sudo().create(
@@ -84,6 +192,7 @@ class PaytagAPI(http.Controller):
                 "name": f"Session {transaction_number}",
                 "transaction_number": transaction_number,
                 "state": "scanning",
+                "machine_ip": machine_ip,
             }
         )
 
@@ -96,7 +205,22 @@ class PaytagAPI(http.Controller):
             "message": "Start from Odoo",
         }
 
-        ws_service.send_command(cmd)
+        try:
+            sent = ws_service.send_command(cmd, machine_ip=machine_ip)
+        except PaytagUnknownMachine:
+            request.env.cr.rollback()
+            return self._unknown_machine(machine_ip)
+        except PaytagQueueFull:
+            # do not keep a session the machine was never told about
+            request.env.cr.rollback()
+            return self._queue_full()
+        if not sent:
+            request.env.cr.rollback()
+            return self._json(
+                {"success": False, "error": "Paytag service unavailable, retry later"},
+                status=503,
+                headers={"Retry-After": "1"},
+            )
 
         return self._json(
             {
@@ -115,10 +239,94 @@ class PaytagAPI(http.Controller):
         methods=["GET", "OPTIONS"],
         csrf=False,
     )
-    def get_items(self, session_id=None, **kwargs):
+    @instrument_route("items")
+    def get_items(self, session_id=None, since=None, include=None, fields=None, **kwargs):
+        """
+        Items of a session. With ``since`` (the ``cursor`` of a previous
+        response) only the items created or changed after it are returned,
+        unless an item was deleted meanwhile, in which case ``full`` is set
+        and the whole session is returned.
+
+        Product stock (``qty_available``) is only computed when asked for
+        with ``include=stock`` or ``fields=qty_available``.
+        """
         if request.httprequest.method == "OPTIONS":
             return Response(status=200, headers=self._cors_headers())
 
+        include_stock = "stock" in (include or "").split(",") or (
+            "qty_available" in (fields or "").split(",")
+        )
+        etag = None if include_stock else self._items_etag(session_id, since)
+        if etag is None:
+            # stock moves do not bump the session version: never cached
+            data, status = self._session_items(
+                session_id, since=since, include_stock=include_stock
+            )
+            return self._json(data, status=status)
+
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag in self._if_none_match():
+            return Response(status=304, headers=dict(self._cors_headers(), **headers))
+        key = (request.env.cr.dbname, etag)
+        with PaytagAPI._items_cache_lock:
+            body = PaytagAPI._items_cache.get(key)
+            if body is not None:
+                PaytagAPI._items_cache.move_to_end(key)
+        if body is None:
+            data, status = self._session_items(session_id, since=since)
+            if status != 200:
+                return self._json(data, status=status)
+            body = json.dumps(data, ensure_ascii=False)
+            with PaytagAPI._items_cache_lock:
+                PaytagAPI._items_cache[key] = body
+                while len(PaytagAPI._items_cache) > ITEMS_CACHE_SIZE:
+                    PaytagAPI._items_cache.popitem(last=False)
+        return self._json_body(body, headers=headers)
+
+    def _if_none_match(self):
+        """ETags sent by the client in If-None-Match."""
+        header = request.httprequest.headers.get("If-None-Match") or ""
+        return {tag.strip() for tag in header.split(",") if tag.strip()}
+
+    def _items_etag(self, session_id, since):
+        """
+        ETag of the ``/api/paytag/items`` response, or None when the session
+        does not exist. It is built from the session version (``change_seq``,
+        bumped by every item change, and ``write_date``), the product version
+        (bumped when a product name, code or list price changes) plus whatever
+        else shapes the body, and is read without touching item or product rows.
+        """
+        try:
+            session_id = int(session_id) if session_id else None
+        except (TypeError, ValueError):
+            return None
+        if session_id:
+            request.env.cr.execute(
+                "SELECT id, change_seq, unlink_seq, write_date, machine_ip FROM paytag_session WHERE id = %s",
+                [session_id],
+            )
+        else:
+            request.env.cr.execute(
+                "SELECT id, change_seq, unlink_seq, write_date, machine_ip FROM paytag_session ORDER BY id DESC LIMIT 1"
+            )
+        row = request.env.cr.fetchone()
+        if not row:
+            return None
+        session_id, change_seq, unlink_seq, write_date, machine_ip = row
+        try:
+            since = int(since) if since not in (None, "") else None
+        except ValueError:
+            since = None
+        if since is None or since < (unlink_seq or 0):
+            # full reload
+            since = "full"
+        connected = request.env["paytag.websocket.service"].sudo().machine_connected(machine_ip)
+        version = write_date.strftime("%Y%m%d%H%M%S%f") if write_date else "0"
+        product_version = request.env["product.product"].sudo()._paytag_product_version()
+        return f'W/"{session_id}-{change_seq or 0}-{version}-{product_version}-{since}-{int(connected)}"'
+
+    def _session_items(self, session_id=None, since=None, include_stock=False):
+        """Return the ``(payload, status)`` served by ``/api/paytag/items``."""
         Session = request.env["paytag.session"].sudo()
 
         # session_id can come from query string or from internal call
@@ -131,55 +339,102 @@ class PaytagAPI(http.Controller):
             session = Session.search([], limit=1, order="id desc")
 
         if not session:
-            return self._json(
-                {"success": False, "error": "No session found"},
-                status=404,
-            )
+            return {"success": False, "error": "No session found"}, 404
 
-        items_data = []
-        for item in session.paytag_item_ids:
-            product = item.product_id
-            items_data.append(
-                {
-                    "id": item.id,
-                    "barcode": item.barcode or "",
-                    "rfid": item.rfid or "",
-                    "is_ht": bool(item.is_ht),
-                    "status": item.status or "",
-                    "message": item.message or "",
-                    "product": {
-                        "id": product.id,
-                        "name": product.display_name,
-                        "default_code": product.default_code,
-                        "price": product.lst_price,
-                        "qty_available": product.qty_available,
-                    }
-                    if product
-                    else None,
-                }
-            )
+        try:
+            since = int(since) if since not in (None, "") else None
+        except ValueError:
+            since = None
+        full = since is None or since < session.unlink_seq
+        Item = request.env["paytag.item"].sudo()
+        domain = [("session_id", "=", session.id)]
+        if not full:
+            domain.append(("change_seq", ">", since))
+        items_data = Item._serialize_items(domain, include_stock=include_stock)
+
+        # counters are stored on the session, no need to load its items
+        total_items = session.items_count
+        paid_items = session.paid_count
+        unpaid_items = session.unpaid_count + session.added_count + session.removed_count
 
-        # compute counts from items
-        total_items = len(session.paytag_item_ids)
-        paid_items = len(
-            session.paytag_item_ids.filtered(lambda i: i.status == "paid")
-        )
-        unpaid_items = len(
-            session.paytag_item_ids.filtered(
-                lambda i: i.status in ("unpaid", "added", "removed")
+        return {
+            "success": True,
+            "session_id": session.id,
+            "state": session.state,
+            "machine_connected": request.env["paytag.websocket.service"].sudo().machine_connected(
+                session.machine_ip
+            ),
+            "cursor": session.change_seq,
+            "full": full,
+            "items": items_data,
+            "total_items": total_items,
+            "paid_items": paid_items,
+            "unpaid_items": unpaid_items,
+        }, 200
+
+    # ------------- Long-poll item events for a session -------------
+
+    @http.route(
+        "/api/paytag/items/poll",
+        type="http",
+        auth="none",
+        methods=["GET", "OPTIONS"],
+        csrf=False,
+    )
+    @instrument_route("items/poll")
+    def poll_items(self, session_id=None, cursor=None, timeout=None, **kwargs):
+        """
+        Hold the request until items of the session are created or change
+        status, then return those events and the cursor to poll from next.
+
+        Without ``cursor`` the current cursor is returned right away with
+        ``reset`` set, meaning the client should load ``/api/paytag/items``
+        once and then poll from that cursor. ``reset`` is also set when the
+        events after the cursor are no longer known to this worker.
+
+        Every waiting poll occupies one of the server's HTTP workers, which
+        then cannot serve /start, /stop or /neutralize, so the wait is
+        capped at ``MAX_POLL_TIMEOUT`` seconds: size the worker count for
+        the kiosks polling at once, and have them poll again right away.
+        """
+        if request.httprequest.method == "OPTIONS":
+            return Response(status=200, headers=self._cors_headers())
+
+        try:
+            session_id = int(session_id)
+        except (TypeError, ValueError):
+            return self._json(
+                {"success": False, "error": "session_id is required"},
+                status=400,
             )
-        )
+        try:
+            timeout = min(MAX_POLL_TIMEOUT, max(0, float(timeout)))
+        except (TypeError, ValueError):
+            timeout = DEFAULT_POLL_TIMEOUT
+
+        notifier = get_item_notifier(request.env.cr.dbname)
+        events, reset = [], True
+        if cursor not in (None, ""):
+            try:
+                cursor = int(cursor)
+            except ValueError:
+                cursor = None
+            else:
+                # do not keep the request's transaction open while waiting
+                request.env.cr.rollback()
+                events, reset = notifier.wait_events(session_id, cursor, timeout)
+        if reset or cursor is None:
+            cursor = notifier.current_cursor()
+        elif events:
+            cursor = events[-1]["seq"]
 
         return self._json(
             {
                 "success": True,
-                "session_id": session.id,
-                "state": session.state,
-                "machine_connected": False,  # placeholder for now
-                "items": items_data,
-                "total_items": total_items,
-                "paid_items": paid_items,
-                "unpaid_items": unpaid_items,
+                "session_id": session_id,
+                "cursor": cursor,
+                "reset": reset,
+                "events": events,
             }
         )
 
@@ -192,6 +447,7 @@ class PaytagAPI(http.Controller):
         methods=["POST", "OPTIONS"],
         csrf=False,
     )
+    @instrument_route("get_items")
     def command_get_items(self, **kwargs):
         if request.httprequest.method == "OPTIONS":
             return Response(status=200, headers=self._cors_headers())
@@ -202,7 +458,10 @@ class PaytagAPI(http.Controller):
         except Exception:
             data = {}
 
-        request_code = data.get("request_code") or f"req-{int(datetime.now().timestamp())}"
+        request_code = data.get("request_code") or f"req-{uuid.uuid4().hex}"
+        machine_ip = self._machine_ip(data)
+        if not self._machine_allowed(machine_ip):
+            return self._unknown_machine(machine_ip)
 
         ws_service = request.env["paytag.websocket.service"].sudo()
         ws_service.ensure_running()
@@ -213,10 +472,18 @@ class PaytagAPI(http.Controller):
             "message": "Get items from Odoo",
         }
 
-        ws_service.send_command(cmd)
+        wait_ms = self._reply_wait_ms(data)
+        try:
+            reply = ws_service.send_command(cmd, wait_ms=wait_ms, machine_ip=machine_ip)
+        except PaytagUnknownMachine:
+            return self._unknown_machine(machine_ip)
+        except PaytagQueueFull:
+            return self._queue_full()
 
-        # We can't wait for the response over HTTP, so just return current DB state
-        return self.get_items(session_id=data.get("session_id"))
+        # Return the device's answer together with the current DB state
+        result, status = self._session_items(session_id=data.get("session_id"))
+        result.update(self._device_result(reply, wait_ms))
+        return self._json(result, status=status)
 
     # ------------- Neutralize -------------
 
@@ -227,6 +494,7 @@ class PaytagAPI(http.Controller):
         methods=["POST", "OPTIONS"],
         csrf=False,
     )
+    @instrument_route("neutralize")
     def neutralize(self, **kwargs):
         if request.httprequest.method == "OPTIONS":
             return Response(status=200, headers=self._cors_headers())
@@ -237,31 +505,94 @@ class PaytagAPI(http.Controller):
         except Exception:
             data = {}
 
-        barcodes = data.get("barcodes", [])
+        barcodes = [str(code).strip() for code in data.get("barcodes") or [] if str(code).strip()]
         transaction_number = data.get("transaction_number") or ""
-        request_code = data.get("request_code") or f"req-{int(datetime.now().timestamp())}"
+        request_code = data.get("request_code") or f"req-{uuid.uuid4().hex}"
+        machine_ip = self._machine_ip(data)
+        if not self._machine_allowed(machine_ip):
+            return self._unknown_machine(machine_ip)
+
+        Line = request.env["paytag.neutralize.line"].sudo()
+        if Line.search_count([("request_code", "=", request_code)]):
+            return self._json(
+                {"success": False, "error": "request_code already used"},
+                status=409,
+            )
 
         ws_service = request.env["paytag.websocket.service"].sudo()
         ws_service.ensure_running()
 
-        cmd = {
-            "command": "neutralize",
-            "request_code": request_code,
-            "transaction_number": transaction_number,
-            "barcodes": barcodes,
-            "options": data.get("options", []),
-            "message": "Neutralize from Odoo",
-        }
-
-        ws_service.send_command(cmd)
-
+        Session = request.env["paytag.session"].sudo()
+        session = Session.browse()
+        if data.get("session_id"):
+            try:
+                session = Session.browse(int(data["session_id"])).exists()
+            except (TypeError, ValueError):
+                pass
+        elif transaction_number:
+            session = Session.search([("transaction_number", "=", transaction_number)], limit=1, order="id desc")
+
+        # Split into device-sized chunks; the first ones go out now and each
+        # device reply sends the next (see paytag.neutralize.line)
+        Line._neutralize_enqueue(
+            request_code,
+            barcodes,
+            session=session,
+            machine_ip=machine_ip,
+            transaction_number=transaction_number,
+            options=data.get("options", []),
+        )
+        commands = Line._neutralize_dispatch(request_code)
+        # lines must be visible to the leader before the device can answer
+        request.env.cr.commit()
+
+        wait_ms = self._reply_wait_ms(data)
+        reply, rejected = Line._neutralize_send(commands, wait_ms=wait_ms)
+        if rejected:
+            Line._neutralize_fail(rejected, "Command queue full")
+            if len(rejected) == len(commands):
+                return self._queue_full()
+
+        status = Line._neutralize_status(request_code)
         return self._json(
-            {
-                "success": True,
-                "queued_barcodes": len(barcodes),
-            }
+            dict(
+                {
+                    "success": True,
+                    "request_code": request_code,
+                    "queued_barcodes": len(barcodes),
+                    "chunks": len({line["chunk"] for line in status["barcodes"]}),
+                    "counts": status["counts"],
+                },
+                **self._device_result(reply, wait_ms),
+            )
         )
 
+    @http.route(
+        "/api/paytag/neutralize/status",
+        type="http",
+        auth="none",
+        methods=["GET", "OPTIONS"],
+        csrf=False,
+    )
+    @instrument_route("neutralize/status")
+    def neutralize_status(self, request_code=None, **kwargs):
+        """Per-barcode progress (queued, sent, confirmed, failed) of a neutralization request."""
+        if request.httprequest.method == "OPTIONS":
+            return Response(status=200, headers=self._cors_headers())
+
+        if not request_code:
+            return self._json(
+                {"success": False, "error": "request_code is required"},
+                status=400,
+            )
+        status = request.env["paytag.neutralize.line"].sudo()._neutralize_status(request_code)
+        if not status["total"]:
+            return self._json(
+                {"success": False, "error": "Unknown request_code"},
+                status=404,
+            )
+        return self._json(dict({"success": True}, **status))
+
     # ------------- Stop -------------
 
     @http.route(
@@ -271,6 +602,7 @@ class PaytagAPI(http.Controller):
         methods=["POST", "OPTIONS"],
         csrf=False,
     )
+    @instrument_route("stop")
     def stop(self, **kwargs):
         if request.httprequest.method == "OPTIONS":
             return Response(status=200, headers=self._cors_headers())
@@ -281,7 +613,10 @@ class PaytagAPI(http.Controller):
         except Exception:
             data = {}
 
-        request_code = data.get("request_code") or f"req-{int(datetime.now().timestamp())}"
+        request_code = data.get("request_code") or f"req-{uuid.uuid4().hex}"
+        machine_ip = self._machine_ip(data)
+        if not self._machine_allowed(machine_ip):
+            return self._unknown_machine(machine_ip)
 
         ws_service = request.env["paytag.websocket.service"].sudo()
         ws_service.ensure_running()
@@ -292,7 +627,13 @@ class PaytagAPI(http.Controller):
             "message": "Stop from Odoo",
         }
 
-        ws_service.send_command(cmd)
+        wait_ms = self._reply_wait_ms(data)
+        try:
+            reply = ws_service.send_command(cmd, wait_ms=wait_ms, machine_ip=machine_ip)
+        except PaytagUnknownMachine:
+            return self._unknown_machine(machine_ip)
+        except PaytagQueueFull:
+            return self._queue_full()
 
         # Optionally close last session
         Session = request.env["paytag.session"].sudo()
@@ -302,12 +643,14 @@ class PaytagAPI(http.Controller):
             except Exception:
                 session = Session.browse()
         else:
-            session = Session.search([], limit=1, order="id desc")
+            session = ws_service._get_active_session(
+                request.env, machine_ip=data.get("machine_ip"), create=False
+            ) or Session.search([], limit=1, order="id desc")
 
         if session:
             session.state = "done"
 
-        return self._json({"success": True})
+        return self._json(dict({"success": True}, **self._device_result(reply, wait_ms)))
 
     # ------------- Test endpoint: add item to a session (no real machine) -------------
 
@@ -318,6 +661,7 @@ class PaytagAPI(http.Controller):
         methods=["POST", "OPTIONS"],
         csrf=False,
     )
+    @instrument_route("add_item")
     def add_item(self, **kwargs):
         """
         Test-only helper to simulate a scanned item.
@@ -364,28 +708,28 @@ class PaytagAPI(http.Controller):
         Product = request.env["product.product"].sudo()
         product = None
         if barcode:
-            product = Product.search(
-                [
-                    "|",
-                    ("barcode", "=", barcode),
-                    ("default_code", "=", barcode),
-                ],
-                limit=1,
-            )
+            product_id = Product._paytag_resolve_codes(
+                [barcode], match_default_code=True
+            ).get(barcode)
+            product = Product.browse(product_id) if product_id else None
 
         item_vals = {
-            "session_id": session.id,
             "barcode": barcode,
             "rfid": rfid,
             "is_ht": is_ht,
             "status": "added",
-            "first_seen": fields.Datetime.now(),
-            "last_seen": fields.Datetime.now(),
             "product_id": product.id if product else False,
             "message": "Test item from API",
         }
 
-        item = request.env["paytag.item"].sudo().create(item_vals)
+        # Upsert, so posting the same tag twice updates it instead of duplicating it
+        created, changed = request.env["paytag.item"].sudo()._upsert_tag_events(session.id, [item_vals])
+        created._notify_item_events("created")
+        changed._notify_item_events("updated")
+        item = created or changed or request.env["paytag.item"].sudo().search([
+            ("session_id", "=", session.id),
+            ("rfid", "=", rfid) if rfid else ("barcode", "=", barcode),
+        ], limit=1)
 
         return self._json(
             {
@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
 from . import paytag_session
 from . import paytag_item
+from . import product_product
+from . import product_template
 from . import paytag_websocket
+from . import paytag_neutralize
+from . import paytag_archive
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from odoo import models, fields, api
+import logging
+import time
+from datetime import timedelta
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_ARCHIVE_RETENTION_DAYS = 90
+DEFAULT_ARCHIVE_BATCH_SIZE = 200
+DEFAULT_ARCHIVE_MAX_BATCHES = 50
+# States of the sessions the archival job may move or delete
+ARCHIVABLE_SESSION_STATES = ('done', 'cancelled')
+
+
+class PaytagSessionArchive(models.Model):
+    _name = "paytag.session.archive"
+    _description = "Paytag Session Archive"
+    _order = "start_time desc, id desc"
+
+    # id the session had in paytag.session
+    session_ref = fields.Integer(string="Original Session ID", readonly=True, index=True)
+    name = fields.Char(string="Session Name", readonly=True)
+    transaction_number = fields.Char(string="Transaction Number", readonly=True, index=True)
+    state = fields.Char(string="State", readonly=True)
+    start_time = fields.Datetime(string="Start Time", readonly=True)
+    end_time = fields.Datetime(string="End Time", readonly=True)
+    machine_ip = fields.Char(string="Machine IP", readonly=True)
+    items_count = fields.Integer(string="Items Count", readonly=True)
+    paid_count = fields.Integer(string="Paid Items", readonly=True)
+    neutralized_count = fields.Integer(string="Neutralized Items", readonly=True)
+    # JSON list of [rfid, barcode, status, product_id, is_ht], one per item
+    items = fields.Text(string="Items", readonly=True)
+
+    @api.model
+    def _cron_archive_sessions(self):
+        """
+        Move ``done``/``cancelled`` sessions that ended more than
+        ``paytag.archive_retention_days`` ago out of the hot tables, in
+        batches of ``paytag.archive_batch_size`` sessions committed one by
+        one, at most ``paytag.archive_max_batches`` batches per run.
+
+        With ``paytag.archive_mode`` = ``delete`` the sessions and their
+        items are only deleted, otherwise each session is first summarized
+        into one ``paytag.session.archive`` row. Return the rows moved.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        retention_days = int(ICP.get_param('paytag.archive_retention_days', DEFAULT_ARCHIVE_RETENTION_DAYS))
+        batch_size = max(1, int(ICP.get_param('paytag.archive_batch_size', DEFAULT_ARCHIVE_BATCH_SIZE)))
+        max_batches = max(1, int(ICP.get_param('paytag.archive_max_batches', DEFAULT_ARCHIVE_MAX_BATCHES)))
+        delete_only = ICP.get_param('paytag.archive_mode', 'archive') == 'delete'
+        cutoff = fields.Datetime.now() - timedelta(days=retention_days)
+
+        report = {'sessions': 0, 'items': 0, 'archived': 0, 'batches': 0}
+        started = time.monotonic()
+        while report['batches'] < max_batches:
+            # sessions being edited elsewhere are left for the next run
+            self.env.cr.execute("""
+                SELECT id FROM paytag_session
+                 WHERE state IN %s AND COALESCE(end_time, start_time, create_date) < %s
+                 ORDER BY id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+            """, [ARCHIVABLE_SESSION_STATES, cutoff, batch_size])
+            session_ids = tuple(row[0] for row in self.env.cr.fetchall())
+            if not session_ids:
+                break
+            if not delete_only:
+                report['archived'] += self._archive_session_rows(session_ids)
+            # plain SQL: the ORM unlink of paytag.item maintains counters of sessions about to go
+            self.env.cr.execute("DELETE FROM paytag_item WHERE session_id IN %s", [session_ids])
+            report['items'] += self.env.cr.rowcount
+            self.env.cr.execute("DELETE FROM paytag_session WHERE id IN %s", [session_ids])
+            report['sessions'] += self.env.cr.rowcount
+            report['batches'] += 1
+            # keep every batch short: commit releases its row locks
+            self.env.cr.commit()
+            if len(session_ids) < batch_size:
+                break
+
+        self.env['paytag.item'].invalidate_model()
+        self.env['paytag.session'].invalidate_model()
+        _logger.info(
+            "Paytag archival (%s, older than %s): %d sessions and %d items moved in %d batches, %.1f s",
+            'delete' if delete_only else 'archive', cutoff, report['sessions'], report['items'],
+            report['batches'], time.monotonic() - started,
+        )
+        return report
+
+    @api.model
+    def _archive_session_rows(self, session_ids):
+        """Summarize the sessions ``session_ids`` and their items into archive rows."""
+        self.env.cr.execute("""
+            INSERT INTO paytag_session_archive
+                   (session_ref, name, transaction_number, state, start_time, end_time, machine_ip,
+                    items_count, paid_count, neutralized_count, items,
+                    create_uid, create_date, write_uid, write_date)
+            SELECT s.id, s.name, s.transaction_number, s.state, s.start_time, s.end_time, s.machine_ip,
+                   COALESCE(s.items_count, 0), COALESCE(s.paid_count, 0), COALESCE(s.neutralized_count, 0),
+                   COALESCE((
+                       SELECT json_agg(json_build_array(i.rfid, i.barcode, i.status, i.product_id, i.is_ht)
+                                       ORDER BY i.id)
+                         FROM paytag_item i
+                        WHERE i.session_id = s.id
+                   ), '[]'::json)::text,
+                   %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC'
+              FROM paytag_session s
+             WHERE s.id IN %(ids)s
+        """, {'uid': self.env.uid, 'ids': session_ids})
+        return self.env.cr.rowcount
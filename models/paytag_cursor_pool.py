@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from contextlib import contextmanager
+
+from odoo import api, registry, SUPERUSER_ID
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CURSOR_POOL_SIZE = 2
+
+
+class PaytagCursorPool(object):
+    """
+    Small pool of long-lived cursors used by the websocket service for its
+    own database work, so ingestion neither opens a connection per batch
+    nor borrows the cursor of the request or cron that started the thread.
+
+    Every ``environment()`` block is one transaction: committed when the
+    block succeeds, rolled back when it raises. Cursors whose connection
+    broke are dropped and replaced on next use.
+    """
+
+    def __init__(self, dbname, size=DEFAULT_CURSOR_POOL_SIZE):
+        self.dbname = dbname
+        self.size = max(1, size)
+        self.idle = []
+        self.opened = 0
+        self.condition = threading.Condition()
+
+    def _take(self):
+        with self.condition:
+            while not self.idle and self.opened >= self.size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.opened += 1
+        try:
+            return registry(self.dbname).cursor()
+        except Exception:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify()
+            raise
+
+    def _give_back(self, cr, broken=False):
+        with self.condition:
+            if broken:
+                self.opened -= 1
+            else:
+                self.idle.append(cr)
+            self.condition.notify()
+        if broken:
+            try:
+                cr.close()
+            except Exception:
+                pass
+
+    @contextmanager
+    def environment(self, uid=SUPERUSER_ID, context=None):
+        """Yield a superuser environment on a pooled cursor, as one transaction."""
+        cr = self._take()
+        broken = False
+        try:
+            env = api.Environment(cr, uid, context or {})
+            # other processes may have changed anything since the last batch
+            env.invalidate_all()
+            yield env
+            cr.commit()
+        except Exception:
+            try:
+                cr.rollback()
+            except Exception:
+                _logger.warning("Dropping broken Paytag cursor", exc_info=True)
+                broken = True
+            raise
+        finally:
+            self._give_back(cr, broken=broken or cr.closed)
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.opened -= len(idle)
+        for cr in idle:
+            try:
+                cr.close()
+            except Exception:
+                pass
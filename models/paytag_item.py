@@ -1,9 +1,22 @@
 # -*- coding: utf-8 -*-
 from odoo import models, fields, api
+from odoo.tools import sql
 import logging
 
+from .paytag_notifier import ITEM_EVENTS_SEQUENCE, publish_item_events
+
 _logger = logging.getLogger(__name__)
 
+# Fields exposed by /api/paytag/items; changing one makes the item part of the next delta
+DELTA_FIELDS = {'rfid', 'barcode', 'is_ht', 'status', 'message', 'product_id', 'session_id'}
+
+# A tag is identified in its session by its RFID, or by its barcode when it has no RFID.
+# name -> (columns, predicate); the predicate makes both unique indexes partial.
+ITEM_TAG_KEYS = {
+    'rfid': ("session_id, rfid", "rfid IS NOT NULL AND rfid <> ''"),
+    'barcode': ("session_id, barcode", "(rfid IS NULL OR rfid = '') AND barcode IS NOT NULL AND barcode <> ''"),
+}
+
 
 class PaytagItem(models.Model):
     _name = "paytag.item"
@@ -46,3 +59,255 @@ class PaytagItem(models.Model):
 
     # Optional message (we use it in the controller)
     message = fields.Char(string="Message")
+
+    # Value of the session's change_seq when the item last changed
+    change_seq = fields.Integer(string="Change Sequence", index=True, readonly=True, copy=False)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        Session = self.env['paytag.session']
+        session_ids = {vals['session_id'] for vals in vals_list if vals.get('session_id')}
+        seqs = Session.browse(session_ids)._bump_change_seq()
+        deltas = {}
+        default_status = self._fields['status'].default(self)
+        for vals in vals_list:
+            if vals.get('session_id'):
+                vals['change_seq'] = seqs[vals['session_id']]
+                status = vals.get('status', default_status)
+                session_deltas = deltas.setdefault(vals['session_id'], {})
+                session_deltas[status] = session_deltas.get(status, 0) + 1
+        Session._apply_count_deltas(deltas)
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if not DELTA_FIELDS.intersection(vals):
+            return super().write(vals)
+        Session = self.env['paytag.session']
+        if 'status' in vals or 'session_id' in vals:
+            Session._apply_count_deltas(self._count_deltas(vals))
+        if 'session_id' in vals:
+            # items moved away disappear from their previous session
+            (self.session_id - Session.browse(vals['session_id']))._bump_change_seq(unlink=True)
+            target = Session.browse(vals['session_id'])
+            seqs = target._bump_change_seq()
+            return super().write(dict(vals, change_seq=seqs.get(target.id, 0)))
+        seqs = self.session_id._bump_change_seq()
+        for session_id, seq in seqs.items():
+            super(PaytagItem, self.filtered(lambda i: i.session_id.id == session_id)).write(
+                dict(vals, change_seq=seq))
+        without_session = self.filtered(lambda i: not i.session_id)
+        if without_session:
+            super(PaytagItem, without_session).write(vals)
+        return True
+
+    def unlink(self):
+        Session = self.env['paytag.session']
+        Session._apply_count_deltas(self._count_deltas(None))
+        self.session_id._bump_change_seq(unlink=True)
+        return super().unlink()
+
+    def _count_deltas(self, vals):
+        """
+        Changes of the per-status session counters when ``vals`` is written
+        on these items (or when they are deleted if ``vals`` is None), as
+        ``{session_id: {status: delta}}``.
+        """
+        deltas = {}
+
+        def add(session_id, status, delta):
+            if session_id:
+                session_deltas = deltas.setdefault(session_id, {})
+                session_deltas[status] = session_deltas.get(status, 0) + delta
+
+        for item in self:
+            add(item.session_id.id, item.status, -1)
+            if vals is not None:
+                add(vals.get('session_id', item.session_id.id), vals.get('status', item.status), 1)
+        return deltas
+
+    def init(self):
+        super().init()
+        self.env.cr.execute(f"CREATE SEQUENCE IF NOT EXISTS {ITEM_EVENTS_SEQUENCE}")
+        for key, (columns, predicate) in ITEM_TAG_KEYS.items():
+            index_name = f"paytag_item_session_{key}_uniq"
+            if sql.index_exists(self.env.cr, index_name):
+                continue
+            # the upserts need the index: merge the duplicates left by the former
+            # search-then-create ingestion, or let the upgrade fail
+            self._merge_duplicate_tags(key)
+            self.env.cr.execute(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON paytag_item ({columns}) WHERE {predicate}")
+        # neutralizer frames look items up by barcode within a session, tagged or not
+        self.env.cr.execute(
+            "CREATE INDEX IF NOT EXISTS paytag_item_session_barcode_index ON paytag_item (session_id, barcode)")
+
+    def _merge_duplicate_tags(self, key):
+        """
+        Keep one item per tag ``key`` ('rfid' or 'barcode', see
+        ``ITEM_TAG_KEYS``) in every session, the one changed last, and
+        delete the others.
+        """
+        columns, predicate = ITEM_TAG_KEYS[key]
+        self.env.cr.execute(f"""
+            DELETE FROM paytag_item i
+             USING (
+                    SELECT id, row_number() OVER (
+                               PARTITION BY {columns}
+                               ORDER BY change_seq DESC NULLS LAST, write_date DESC NULLS LAST, id DESC
+                           ) AS rank
+                      FROM paytag_item
+                     WHERE session_id IS NOT NULL AND {predicate}
+                   ) duplicate
+             WHERE i.id = duplicate.id AND duplicate.rank > 1
+         RETURNING i.session_id
+        """)
+        session_ids = {row[0] for row in self.env.cr.fetchall()}
+        if not session_ids:
+            return
+        _logger.warning("Merged duplicate %s items of %d Paytag sessions", key, len(session_ids))
+        sessions = self.env['paytag.session'].browse(session_ids)
+        sessions._rebuild_item_counters()
+        # clients holding deltas of these sessions must reload them
+        sessions._bump_change_seq(unlink=True)
+        self.invalidate_model()
+
+    @api.model
+    def _upsert_tag_events(self, session_id, events):
+        """
+        Insert or update the items of ``session_id`` described by ``events``
+        (dicts with rfid, barcode, status and optionally product_id, is_ht and
+        message) with one ``INSERT ... ON CONFLICT DO UPDATE`` per tag key.
+
+        Events must hold at most one entry per tag. Change sequence, session
+        counters and ORM caches are kept in sync as the ORM would; return
+        ``(created, changed)`` item recordsets.
+        """
+        Session = self.env['paytag.session']
+        seq = Session.browse(session_id)._bump_change_seq()[session_id]
+        now = fields.Datetime.now()
+        created_ids = []
+        changed_ids = []
+        deltas = {}
+
+        def count(status, delta):
+            session_deltas = deltas.setdefault(session_id, {})
+            session_deltas[status] = session_deltas.get(status, 0) + delta
+
+        for key, (columns, predicate) in ITEM_TAG_KEYS.items():
+            rows = [ev for ev in events if bool(ev.get('rfid')) == (key == 'rfid')]
+            if not rows:
+                continue
+            values = []
+            params = [session_id, tuple(ev[key] for ev in rows)]
+            # an event without is_ht inserts False but keeps the value of an existing item
+            is_ht_known = [ev[key] for ev in rows if ev.get('is_ht') is not None]
+            is_ht = f"CASE WHEN EXCLUDED.{key} = ANY(%s) THEN EXCLUDED.is_ht ELSE item.is_ht END"
+            for ev in rows:
+                values.append("(%s, %s, %s, %s, %s, COALESCE(%s, false), %s, %s, %s, %s, %s, %s, %s, %s)")
+                params += [
+                    session_id, ev.get('rfid') or '', ev.get('barcode') or '', ev['status'],
+                    ev.get('product_id') or None, ev.get('is_ht'), ev.get('message'),
+                    now, now, seq, self.env.uid, now, self.env.uid, now,
+                ]
+            self.env.cr.execute(f"""
+                WITH previous AS (
+                    SELECT id, status, change_seq FROM paytag_item
+                     WHERE session_id = %s AND {key} IN %s AND {predicate}
+                ), upserted AS (
+                    INSERT INTO paytag_item AS item
+                           (session_id, rfid, barcode, status, product_id, is_ht, message,
+                            first_seen, last_seen, change_seq, create_uid, create_date, write_uid, write_date)
+                    VALUES {", ".join(values)}
+                    ON CONFLICT ({columns}) WHERE {predicate}
+                    DO UPDATE SET status = EXCLUDED.status,
+                                  barcode = EXCLUDED.barcode,
+                                  product_id = COALESCE(EXCLUDED.product_id, item.product_id),
+                                  is_ht = {is_ht},
+                                  message = COALESCE(EXCLUDED.message, item.message),
+                                  last_seen = EXCLUDED.last_seen,
+                                  change_seq = CASE
+                                      WHEN (item.status, item.barcode, item.product_id, item.is_ht, item.message)
+                                           IS DISTINCT FROM
+                                           (EXCLUDED.status, EXCLUDED.barcode,
+                                            COALESCE(EXCLUDED.product_id, item.product_id),
+                                            {is_ht},
+                                            COALESCE(EXCLUDED.message, item.message))
+                                      THEN EXCLUDED.change_seq ELSE item.change_seq END,
+                                  write_uid = EXCLUDED.write_uid,
+                                  write_date = EXCLUDED.write_date
+                    RETURNING item.id, item.status, item.change_seq, (item.xmax = 0) AS inserted
+                )
+                SELECT u.id, u.status, u.inserted, p.status, p.change_seq IS DISTINCT FROM u.change_seq
+                  FROM upserted u LEFT JOIN previous p ON p.id = u.id
+            """, params + [is_ht_known, is_ht_known])
+            for item_id, status, inserted, previous_status, changed in self.env.cr.fetchall():
+                if inserted:
+                    created_ids.append(item_id)
+                    count(status, 1)
+                elif changed:
+                    changed_ids.append(item_id)
+                    if previous_status != status:
+                        count(previous_status, -1)
+                        count(status, 1)
+
+        Session._apply_count_deltas(deltas)
+        self.invalidate_model()
+        return self.browse(created_ids), self.browse(changed_ids)
+
+    @api.model
+    def _serialize_items(self, domain, include_stock=False):
+        """
+        Return the items matching ``domain`` in the shape served by
+        ``/api/paytag/items``.
+
+        Items are read with one search_read and their products with one
+        read, whatever the basket size; the stock quantity is only
+        computed when ``include_stock`` is set.
+        """
+        rows = self.sudo().search_read(
+            domain, ['barcode', 'rfid', 'is_ht', 'status', 'message', 'product_id'], order='id')
+        product_fields = ['default_code', 'lst_price']
+        Product = self.env['product.product'].sudo()
+        if include_stock and 'qty_available' in Product._fields:
+            product_fields.append('qty_available')
+        product_ids = {row['product_id'][0] for row in rows if row['product_id']}
+        products = {p['id']: p for p in Product.browse(product_ids).read(product_fields)}
+
+        items = []
+        for row in rows:
+            product = None
+            if row['product_id']:
+                values = products[row['product_id'][0]]
+                product = {
+                    "id": values['id'],
+                    "name": row['product_id'][1],
+                    "default_code": values['default_code'],
+                    "price": values['lst_price'],
+                }
+                if 'qty_available' in values:
+                    product["qty_available"] = values['qty_available']
+            items.append({
+                "id": row['id'],
+                "barcode": row['barcode'] or "",
+                "rfid": row['rfid'] or "",
+                "is_ht": bool(row['is_ht']),
+                "status": row['status'] or "",
+                "message": row['message'] or "",
+                "product": product,
+            })
+        return items
+
+    def _notify_item_events(self, event):
+        """Publish an ``event`` ('created' or 'updated') for each item to long-poll clients."""
+        publish_item_events(self.env.cr, [
+            {
+                'event': event,
+                'session_id': item.session_id.id,
+                'item_id': item.id,
+                'rfid': item.rfid or '',
+                'barcode': item.barcode or '',
+                'status': item.status or '',
+            }
+            for item in self
+            if item.session_id
+        ])
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta, timezone
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_DAYS = 30
+JOURNAL_FILE_PREFIX = 'frames-'
+JOURNAL_FILE_SUFFIX = '.jsonl.gz'
+
+
+class PaytagJournal(object):
+    """
+    Append-only journal of the raw frames received from the Paytag devices,
+    kept outside the database in ``<data_dir>/paytag_journal/<dbname>``.
+
+    Frames are buffered in memory by the receiver and written by the
+    ingestion workers, one gzip member per flush, to a file per UTC day and
+    process run (``frames-YYYYMMDD-HHMMSSffffff-<pid>.jsonl.gz``, named
+    after the time it was opened so names sort in write order). A member
+    torn by a crash, or by a failed write which also starts a new file,
+    can only end its file. Each line is
+    ``{"ts": <epoch>, "machine_ip": ..., "frame": <raw frame>}``. Files
+    older than ``days`` are removed when a new day starts.
+    """
+
+    def __init__(self, dbname, days=DEFAULT_JOURNAL_DAYS):
+        self.path = os.path.join(config['data_dir'], 'paytag_journal', dbname)
+        self.days = days
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.current_day = None
+        self.current_file = None
+
+    def record(self, machine_ip, text):
+        """Buffer one raw frame (runs on the event loop, no I/O)."""
+        # newlines can only be whitespace between JSON tokens, keep one frame per line
+        text = text.replace('\r', ' ').replace('\n', ' ')
+        line = '{"ts": %.3f, "machine_ip": %s, "frame": %s}\n' % (time.time(), json.dumps(machine_ip), text)
+        with self.buffer_lock:
+            self.buffer.append(line)
+
+    def flush(self):
+        """Write the buffered frames, return how many were written."""
+        with self.write_lock:
+            with self.buffer_lock:
+                lines, self.buffer = self.buffer, []
+            if not lines:
+                return 0
+            now = datetime.utcnow()
+            try:
+                if now.date() != self.current_day:
+                    os.makedirs(self.path, exist_ok=True)
+                    self.current_day = now.date()
+                    self.current_file = None
+                    self._purge(now.date())
+                if self.current_file is None:
+                    self.current_file = os.path.join(
+                        self.path, f"{JOURNAL_FILE_PREFIX}{now.strftime('%Y%m%d-%H%M%S%f')}-{os.getpid()}"
+                                   f"{JOURNAL_FILE_SUFFIX}")
+                with gzip.open(self.current_file, 'ab') as journal:
+                    journal.write(''.join(lines).encode('utf-8'))
+            except OSError:
+                _logger.exception("Could not write %d frames to the Paytag journal", len(lines))
+                # the member may be partly written: later frames go to a new file
+                self.current_file = None
+                return 0
+            return len(lines)
+
+    @staticmethod
+    def _file_day(name):
+        """``YYYYMMDD`` day of a journal file name, None for other files."""
+        if not (name.startswith(JOURNAL_FILE_PREFIX) and name.endswith(JOURNAL_FILE_SUFFIX)):
+            return None
+        return name[len(JOURNAL_FILE_PREFIX):len(JOURNAL_FILE_PREFIX) + 8]
+
+    def _purge(self, today):
+        if not self.days:
+            return
+        oldest = (today - timedelta(days=self.days)).strftime('%Y%m%d')
+        for name in os.listdir(self.path):
+            day = self._file_day(name)
+            if day is not None and day < oldest:
+                os.remove(os.path.join(self.path, name))
+                _logger.info("Removed Paytag journal %s", name)
+
+    def read(self, start=None, end=None, machine_ip=None):
+        """
+        Yield the ``(ts, machine_ip, frame)`` entries journaled between the
+        ``start`` and ``end`` naive UTC datetimes (both optional) in write order.
+        A torn gzip member, left by a crash during a write, ends its file.
+        """
+        if not os.path.isdir(self.path):
+            return
+        first_day = start.date() if start else date.min
+        last_day = end.date() if end else date.max
+        start_ts = start.replace(tzinfo=timezone.utc).timestamp() if start else None
+        end_ts = end.replace(tzinfo=timezone.utc).timestamp() if end else None
+        for name in sorted(os.listdir(self.path)):
+            if self._file_day(name) is None:
+                continue
+            try:
+                day = datetime.strptime(self._file_day(name), '%Y%m%d').date()
+            except ValueError:
+                continue
+            if not first_day <= day <= last_day:
+                continue
+            try:
+                with gzip.open(os.path.join(self.path, name), 'rt', encoding='utf-8') as journal:
+                    for line in journal:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            _logger.warning("Skipping corrupt line in Paytag journal %s", name)
+                            continue
+                        if start_ts is not None and entry['ts'] < start_ts:
+                            continue
+                        if end_ts is not None and entry['ts'] > end_ts:
+                            break
+                        if machine_ip and entry['machine_ip'] != machine_ip:
+                            continue
+                        yield entry['ts'], entry['machine_ip'], entry['frame']
+            except (EOFError, OSError, zlib.error):
+                _logger.warning("Paytag journal %s ends with a truncated write", name)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from sub-millisecond frame handling to slow flushes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class PaytagMetric(object):
+    """Base of the metrics: one value per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        """Current values as ``[[label values, value], ...]``, to be rendered by another process."""
+        with self.lock:
+            return [[list(key), value] for key, value in self.values.items()]
+
+    def render(self, snapshot=None):
+        """Render the current values, or the ones of ``snapshot`` when given."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if snapshot is not None:
+            values = {tuple(key): value for key, value in snapshot}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class PaytagCounter(PaytagMetric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class PaytagGauge(PaytagMetric):
+    """Gauge set explicitly, or read at scrape time from ``callback``."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        # callback() returns {label values tuple: value}
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def _refresh(self):
+        if self.callback is not None:
+            values = self.callback()
+            with self.lock:
+                self.values = dict(values)
+
+    def snapshot(self):
+        self._refresh()
+        return super().snapshot()
+
+    def render(self, snapshot=None):
+        if snapshot is None:
+            self._refresh()
+        return super().render(snapshot)
+
+
+class PaytagHistogram(PaytagMetric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                # per-bucket counts (last one is +Inf), sum
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return [[list(key), [list(counts), total]] for key, (counts, total) in self.values.items()]
+
+    def render(self, snapshot=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        if snapshot is not None:
+            values = {tuple(key): (counts, total) for key, (counts, total) in snapshot}
+        else:
+            with self.lock:
+                values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class PaytagMetricsRegistry(object):
+    """
+    In-process registry of the integration metrics, rendered in the
+    Prometheus text format. Recording is a dict update under a per-metric
+    lock, cheap enough for the hot paths.
+
+    Every Odoo process has its own registry: the websocket metrics live in
+    the leader process, the HTTP ones in whichever worker served the route.
+    The leader publishes a ``snapshot`` of its metrics so the other workers
+    can render them.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(PaytagCounter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._register(PaytagGauge, name, documentation, labelnames, callback=callback)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(PaytagHistogram, name, documentation, labelnames, buckets=buckets)
+
+    def snapshot(self, exclude=()):
+        """Return ``{name: values}`` of the metrics not listed in ``exclude``, JSON serializable."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics if metric.name not in exclude}
+
+    def render(self, snapshot=None):
+        """
+        Render every metric in the Prometheus text format. The metrics found
+        in ``snapshot``, as returned by another process's ``snapshot()``,
+        are rendered with its values instead of this process's.
+        """
+        snapshot = snapshot or {}
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render(snapshot.get(metric.name)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = PaytagMetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'paytag_http_requests_total', "Paytag API requests by route and status code.", ('route', 'status'))
+HTTP_LATENCY = REGISTRY.histogram(
+    'paytag_http_request_seconds', "Time spent serving Paytag API requests.", ('route',))
+WS_CONNECTS = REGISTRY.counter(
+    'paytag_ws_connects_total', "Websocket connections established to a machine.", ('machine',))
+WS_DISCONNECTS = REGISTRY.counter(
+    'paytag_ws_disconnects_total', "Websocket connections to a machine that ended or failed.", ('machine', 'reason'))
+WS_SENT = REGISTRY.counter(
+    'paytag_ws_commands_sent_total', "Commands sent to a machine.", ('machine', 'command'))
+WS_SEND_ERRORS = REGISTRY.counter(
+    'paytag_ws_send_errors_total', "Commands that could not be sent to a machine.", ('machine',))
+WS_SEND_LATENCY = REGISTRY.histogram(
+    'paytag_ws_send_seconds', "Time spent writing a command to the websocket.", ('machine',))
+WS_RECEIVED = REGISTRY.counter(
+    'paytag_ws_frames_received_total', "Frames received from a machine by type.", ('machine', 'type'))
+WS_RECEIVE_ERRORS = REGISTRY.counter(
+    'paytag_ws_receive_errors_total', "Frames from a machine that could not be parsed or handled.", ('machine',))
+DEBOUNCE_SUPPRESSED = REGISTRY.counter(
+    'paytag_debounce_suppressed_total', "Barcode frames dropped by the debounce stage.", ('machine',))
+SPOOL_DROPPED = REGISTRY.counter(
+    'paytag_spool_dropped_total', "Frames lost because the disk spool was full or they could not be applied.",
+    ('machine',))
+PROCESS_LATENCY = REGISTRY.histogram(
+    'paytag_process_seconds', "Time spent applying frames to the database, per frame type "
+    "(barcode frames are applied in runs).", ('type',))
+INGEST_FLUSHES = REGISTRY.counter(
+    'paytag_ingest_batches_total', "Ingestion batches by outcome.", ('machine', 'result'))
+INGEST_FRAMES = REGISTRY.counter(
+    'paytag_ingest_frames_total', "Frames handed to the ingestion workers.", ('machine',))
+INGEST_DROPPED = REGISTRY.counter(
+    'paytag_ingest_dropped_frames_total', "Frames dropped because they failed to apply on their own.", ('machine',))
+INGEST_FLUSH_LATENCY = REGISTRY.histogram(
+    'paytag_ingest_flush_seconds', "Time to apply and commit one ingestion batch.", ('machine',))
+INGEST_WAIT_LATENCY = REGISTRY.histogram(
+    'paytag_ingest_wait_seconds', "Time an ingestion batch waited for a free worker.")
+
+
+def instrument_route(route):
+    """Decorate a controller method to count and time its requests as ``route``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            status = 500
+            try:
+                response = func(*args, **kwargs)
+                status = getattr(response, 'status_code', 200)
+                return response
+            finally:
+                HTTP_LATENCY.observe(time.perf_counter() - started, route=route)
+                HTTP_REQUESTS.inc(route=route, status=status)
+        return wrapper
+    return decorator
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+from odoo import models, fields, api, registry, SUPERUSER_ID
+import json
+import logging
+from datetime import timedelta
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_NEUTRALIZE_CHUNK_SIZE = 50
+DEFAULT_NEUTRALIZE_MAX_INFLIGHT = 2
+# A sent chunk without a device reply after this many seconds is failed
+NEUTRALIZE_CHUNK_TIMEOUT = 120
+
+
+class PaytagNeutralizeLine(models.Model):
+    _name = "paytag.neutralize.line"
+    _description = "Paytag Neutralization Line"
+    _order = "request_code, chunk, id"
+
+    request_code = fields.Char(string="Request Code", required=True, index=True)
+    chunk = fields.Integer(string="Chunk", required=True, default=0)
+    # request_code of the device command carrying the chunk
+    command_code = fields.Char(string="Command Code", required=True, index=True)
+    barcode = fields.Char(string="Barcode", required=True)
+    state = fields.Selection([
+        ('queued', 'Queued'),
+        ('sent', 'Sent'),
+        ('confirmed', 'Confirmed'),
+        ('failed', 'Failed'),
+    ], default='queued', string="State", required=True, index=True)
+    session_id = fields.Many2one('paytag.session', string="Session", ondelete='cascade', index=True)
+    machine_ip = fields.Char(string="Machine IP")
+    transaction_number = fields.Char(string="Transaction Number")
+    options = fields.Char(string="Options", help="JSON options sent with every chunk")
+    sent_at = fields.Datetime(string="Sent At")
+    message = fields.Char(string="Message")
+
+    @api.model
+    def _neutralize_settings(self):
+        """Return ``(chunk_size, max_inflight)`` from the system parameters."""
+        ICP = self.env['ir.config_parameter'].sudo()
+        try:
+            chunk_size = max(1, int(ICP.get_param('paytag.neutralize_chunk_size', DEFAULT_NEUTRALIZE_CHUNK_SIZE)))
+        except (TypeError, ValueError):
+            chunk_size = DEFAULT_NEUTRALIZE_CHUNK_SIZE
+        try:
+            max_inflight = max(1, int(ICP.get_param('paytag.neutralize_max_inflight', DEFAULT_NEUTRALIZE_MAX_INFLIGHT)))
+        except (TypeError, ValueError):
+            max_inflight = DEFAULT_NEUTRALIZE_MAX_INFLIGHT
+        return chunk_size, max_inflight
+
+    @api.model
+    def _neutralize_enqueue(self, request_code, barcodes, session=None, machine_ip=None,
+                            transaction_number='', options=None):
+        """Split ``barcodes`` into device-sized chunks and record one queued line per barcode."""
+        chunk_size = self._neutralize_settings()[0]
+        options = json.dumps(options or [])
+        return self.create([
+            {
+                'request_code': request_code,
+                'chunk': index // chunk_size,
+                'command_code': f"{request_code}-{index // chunk_size}",
+                'barcode': barcode,
+                'session_id': session.id if session else False,
+                'machine_ip': machine_ip or False,
+                'transaction_number': transaction_number or False,
+                'options': options,
+            }
+            for index, barcode in enumerate(barcodes)
+        ])
+
+    @api.model
+    def _neutralize_dispatch(self, request_code):
+        """
+        Mark the next queued chunks of ``request_code`` as sent, keeping at
+        most ``paytag.neutralize_max_inflight`` chunks in flight, and return
+        the ``(machine_ip, command)`` pairs to send once that is committed.
+        """
+        max_inflight = self._neutralize_settings()[1]
+        lines = self.search([('request_code', '=', request_code), ('state', 'in', ('queued', 'sent'))])
+        if not lines:
+            return []
+        # the reply of a chunk and the timeout cron may dispatch the same request at once
+        self.env.cr.execute(
+            "SELECT id FROM paytag_neutralize_line WHERE id IN %s FOR UPDATE SKIP LOCKED", [tuple(lines.ids)])
+        if len(self.env.cr.fetchall()) < len(lines):
+            # another transaction holds some of them and dispatches the next chunks itself
+            return []
+        inflight = {line.chunk for line in lines if line.state == 'sent'}
+        queued = sorted({line.chunk for line in lines if line.state == 'queued'})
+        chunks = queued[:max(0, max_inflight - len(inflight))]
+        if not chunks:
+            return []
+        to_send = lines.filtered(lambda line: line.state == 'queued' and line.chunk in chunks)
+        to_send.write({'state': 'sent', 'sent_at': fields.Datetime.now()})
+        commands = []
+        for chunk in chunks:
+            chunk_lines = to_send.filtered(lambda line: line.chunk == chunk)
+            first = chunk_lines[0]
+            commands.append((first.machine_ip or None, {
+                "command": "neutralize",
+                "request_code": first.command_code,
+                "transaction_number": first.transaction_number or "",
+                "barcodes": chunk_lines.mapped('barcode'),
+                "options": json.loads(first.options or "[]"),
+                "message": "Neutralize from Odoo",
+            }))
+        return commands
+
+    @api.model
+    def _neutralize_send(self, commands, wait_ms=None):
+        """
+        Queue all the dispatched chunk commands, then with ``wait_ms`` wait
+        for the reply of the first one. Return ``(reply, rejected command codes)``.
+        """
+        return self.env['paytag.websocket.service'].sudo().send_commands(commands, wait_ms=wait_ms)
+
+    @api.model
+    def _neutralize_fail(self, command_codes, message):
+        """Fail the sent lines of ``command_codes``."""
+        if command_codes:
+            self.search([('command_code', 'in', command_codes), ('state', '=', 'sent')]).write(
+                {'state': 'failed', 'message': message})
+
+    def _neutralize_send_after_commit(self, commands):
+        """Send dispatched chunks once the transaction marking them sent is committed."""
+        if not commands:
+            return
+        dbname = self.env.cr.dbname
+
+        def send():
+            rejected = self._neutralize_send(commands)[1]
+            if not rejected:
+                return
+            _logger.warning("Paytag could not queue neutralization chunks %s", rejected)
+            with registry(dbname).cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                env['paytag.neutralize.line']._neutralize_fail(rejected, "Command queue full")
+
+        self.env.cr.postcommit.add(send)
+
+    @api.model
+    def _neutralize_reply(self, payload):
+        """
+        Record the device reply to a chunk command and dispatch the next
+        chunks of its request. Return False when ``payload`` answers no chunk.
+        """
+        command_code = payload.get('request_code')
+        if not command_code:
+            return False
+        lines = self.search([('command_code', '=', command_code), ('state', '=', 'sent')])
+        if not lines:
+            return False
+        if payload.get('error') or payload.get('success') is False:
+            lines.write({'state': 'failed', 'message': str(payload.get('error') or payload.get('message') or '')[:255]})
+        else:
+            lines.write({'state': 'confirmed', 'message': False})
+        _logger.info("Paytag neutralization chunk %s %s (%d barcodes)", command_code, lines[0].state, len(lines))
+        self._neutralize_send_after_commit(self._neutralize_dispatch(lines[0].request_code))
+        return True
+
+    @api.model
+    def _cron_neutralize_timeout(self):
+        """
+        Fail chunks the device never answered, then dispatch the chunks
+        queued behind them or behind chunks that could not be queued.
+        """
+        limit = fields.Datetime.now() - timedelta(seconds=NEUTRALIZE_CHUNK_TIMEOUT)
+        stale = self.search([('state', '=', 'sent'), ('sent_at', '<', limit)])
+        stale.write({'state': 'failed', 'message': "No reply from the device"})
+        waiting = self.search_read([('state', '=', 'queued')], ['request_code'])
+        for request_code in {row['request_code'] for row in waiting}:
+            self._neutralize_send_after_commit(self._neutralize_dispatch(request_code))
+
+    @api.model
+    def _neutralize_status(self, request_code):
+        """Progress of a neutralization request, read with a single query."""
+        rows = self.search_read([('request_code', '=', request_code)], ['barcode', 'chunk', 'state', 'message'])
+        counts = dict.fromkeys(('queued', 'sent', 'confirmed', 'failed'), 0)
+        for row in rows:
+            counts[row['state']] += 1
+        return {
+            "request_code": request_code,
+            "total": len(rows),
+            "counts": counts,
+            "done": bool(rows) and not counts['queued'] and not counts['sent'],
+            "barcodes": [
+                {
+                    "barcode": row['barcode'],
+                    "chunk": row['chunk'],
+                    "state": row['state'],
+                    "message": row['message'] or "",
+                }
+                for row in rows
+            ],
+        }
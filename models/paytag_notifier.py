@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import select
+import threading
+import time
+from collections import deque
+
+import odoo
+
+_logger = logging.getLogger(__name__)
+
+ITEM_EVENTS_CHANNEL = 'paytag_items'
+ITEM_EVENTS_SEQUENCE = 'paytag_item_event_seq'
+# pg_notify payloads must stay below 8000 bytes
+NOTIFY_PAYLOAD_LIMIT = 7900
+EVENTS_PER_SESSION = 1000
+# Last sequence value handed out (last_value is only meaningful once is_called)
+CURRENT_SEQ_QUERY = (
+    f"SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END FROM {ITEM_EVENTS_SEQUENCE}"
+)
+
+
+def publish_item_events(cr, events):
+    """
+    Stamp ``events`` with a global sequence number and publish them on the
+    ``paytag_items`` channel. PostgreSQL only delivers the notification when
+    ``cr`` commits, so listeners never see items that were rolled back.
+    """
+    if not events:
+        return
+    cr.execute("SELECT nextval(%s) FROM generate_series(1, %s)", [ITEM_EVENTS_SEQUENCE, len(events)])
+    for event, (seq,) in zip(events, cr.fetchall()):
+        event['seq'] = seq
+    events.sort(key=lambda ev: ev['seq'])
+    chunk = []
+    size = 2
+    for event in events:
+        encoded = len(json.dumps(event)) + 1
+        if chunk and size + encoded > NOTIFY_PAYLOAD_LIMIT:
+            cr.execute("SELECT pg_notify(%s, %s)", [ITEM_EVENTS_CHANNEL, json.dumps(chunk)])
+            chunk = []
+            size = 2
+        chunk.append(event)
+        size += encoded
+    if chunk:
+        cr.execute("SELECT pg_notify(%s, %s)", [ITEM_EVENTS_CHANNEL, json.dumps(chunk)])
+
+
+class PaytagItemNotifier(threading.Thread):
+    """
+    Per-worker listener of the ``paytag_items`` channel.
+
+    Keeps the last events of every session in memory and wakes up the
+    long-poll requests of this worker waiting on them. Every worker runs its
+    own listener, so a client may poll any of them with the same cursor.
+    """
+
+    def __init__(self, dbname):
+        super().__init__(daemon=True, name=f"paytag-notifier-{dbname}")
+        self.dbname = dbname
+        self.condition = threading.Condition()
+        self.events = {}        # session_id -> deque of events
+        self.evicted_seq = {}   # session_id -> seq of the last event dropped from the deque
+        # Events before this sequence value were published before we listened
+        self.start_seq = None
+        self.ready = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                _logger.exception("Paytag item notifier error, restarting in 5s")
+                with self.condition:
+                    # events may have been missed while disconnected
+                    self.start_seq = None
+                    self.ready.clear()
+                time.sleep(5)
+
+    def _listen(self):
+        with odoo.sql_db.db_connect(self.dbname).cursor() as cr:
+            conn = cr._cnx
+            cr.execute(f"LISTEN {ITEM_EVENTS_CHANNEL}")
+            cr.execute(CURRENT_SEQ_QUERY)
+            start_seq = cr.fetchone()[0]
+            cr.commit()
+            with self.condition:
+                self.events.clear()
+                self.evicted_seq.clear()
+                self.start_seq = start_seq
+            self.ready.set()
+            _logger.info("Paytag item notifier listening on %s", self.dbname)
+            while True:
+                if select.select([conn], [], [], 50) == ([], [], []):
+                    continue
+                conn.poll()
+                batches = []
+                while conn.notifies:
+                    batches.append(json.loads(conn.notifies.pop(0).payload))
+                self._dispatch([ev for batch in batches for ev in batch])
+
+    def _dispatch(self, events):
+        if not events:
+            return
+        with self.condition:
+            for event in events:
+                queue = self.events.setdefault(event['session_id'], deque(maxlen=EVENTS_PER_SESSION))
+                if len(queue) == queue.maxlen:
+                    self.evicted_seq[event['session_id']] = queue[0]['seq']
+                queue.append(event)
+            self.condition.notify_all()
+
+    def wait_events(self, session_id, cursor, timeout):
+        """
+        Return ``(events, reset)`` for the events of ``session_id`` after
+        ``cursor``, waiting up to ``timeout`` seconds for one to arrive.
+        ``reset`` is True when this worker cannot tell what happened after
+        the cursor, in which case the client should reload the full session.
+        """
+        deadline = time.monotonic() + timeout
+        self.ready.wait(timeout)
+        with self.condition:
+            while True:
+                if self.start_seq is None or cursor < self.start_seq \
+                        or cursor < self.evicted_seq.get(session_id, 0):
+                    return [], True
+                events = [ev for ev in self.events.get(session_id, ()) if ev['seq'] > cursor]
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events, False
+                self.condition.wait(remaining)
+
+    def current_cursor(self):
+        with odoo.sql_db.db_connect(self.dbname).cursor() as cr:
+            cr.execute(CURRENT_SEQ_QUERY)
+            return cr.fetchone()[0]
+
+
+_notifiers = {}
+_notifiers_lock = threading.Lock()
+
+
+def get_item_notifier(dbname):
+    """Return the listener of ``dbname`` for this worker, starting it on first use."""
+    with _notifiers_lock:
+        notifier = _notifiers.get(dbname)
+        if notifier is None or not notifier.is_alive():
+            notifier = _notifiers[dbname] = PaytagItemNotifier(dbname)
+            notifier.start()
+        return notifier
@@ -1,9 +1,24 @@
 # -*- coding: utf-8 -*-
 from odoo import models, fields, api
+from odoo.tools import sql
 import logging
 
 _logger = logging.getLogger(__name__)
 
+# States in which a session still accepts scanned items
+ACTIVE_SESSION_STATES = ('waiting', 'scanning')
+# States in which a session may still receive neutralizer frames
+NEUTRALIZER_SESSION_STATES = ACTIVE_SESSION_STATES + ('payment', 'neutralizing')
+# Stored counter of paytag.session for each item status
+ITEM_STATUS_COUNTERS = {
+    'added': 'added_count',
+    'removed': 'removed_count',
+    'paid': 'paid_count',
+    'unpaid': 'unpaid_count',
+    'neutralized': 'neutralized_count',
+}
+
+
 class PaytagSession(models.Model):
     _name = "paytag.session"
     _description = "Paytag Session"
@@ -21,10 +36,134 @@ class PaytagSession(models.Model):
     start_time = fields.Datetime(string="Start Time", default=fields.Datetime.now)
     end_time = fields.Datetime(string="End Time")
     machine_ip = fields.Char(string="Machine IP")
-    items_count = fields.Integer(string="Items Count", compute='_compute_items_count')
+    # Counters maintained by paytag.item in the transaction that changes the items
+    items_count = fields.Integer(string="Items Count", readonly=True, copy=False, default=0)
+    added_count = fields.Integer(string="Added Items", readonly=True, copy=False, default=0)
+    removed_count = fields.Integer(string="Removed Items", readonly=True, copy=False, default=0)
+    paid_count = fields.Integer(string="Paid Items", readonly=True, copy=False, default=0)
+    unpaid_count = fields.Integer(string="Unpaid Items", readonly=True, copy=False, default=0)
+    neutralized_count = fields.Integer(string="Neutralized Items", readonly=True, copy=False, default=0)
     paytag_item_ids = fields.One2many('paytag.item', 'session_id', string="Items", copy=False)
+    # Bumped on every item change; items carry the value of their last change
+    change_seq = fields.Integer(string="Change Sequence", readonly=True, copy=False, default=0)
+    # change_seq of the last item removal, deltas older than this need a full reload
+    unlink_seq = fields.Integer(string="Unlink Sequence", readonly=True, copy=False, default=0)
+
+    def init(self):
+        super().init()
+        if not sql.table_exists(self.env.cr, 'paytag_item'):
+            # first install: paytag.item is initialized after this model
+            return
+        # (re)build the counters from the items, e.g. for sessions created before they existed
+        self._rebuild_item_counters()
+
+    def _rebuild_item_counters(self):
+        """Recompute the stored item counters of these sessions (all of them when empty) from their items."""
+        where = "WHERE sess.id IN %s" if self.ids else ""
+        self.env.cr.execute(f"""
+            UPDATE paytag_session s
+               SET items_count = c.total,
+                   added_count = c.added,
+                   removed_count = c.removed,
+                   paid_count = c.paid,
+                   unpaid_count = c.unpaid,
+                   neutralized_count = c.neutralized
+              FROM (
+                    SELECT sess.id AS session_id,
+                           count(i.id) AS total,
+                           count(i.id) FILTER (WHERE i.status = 'added') AS added,
+                           count(i.id) FILTER (WHERE i.status = 'removed') AS removed,
+                           count(i.id) FILTER (WHERE i.status = 'paid') AS paid,
+                           count(i.id) FILTER (WHERE i.status = 'unpaid') AS unpaid,
+                           count(i.id) FILTER (WHERE i.status = 'neutralized') AS neutralized
+                      FROM paytag_session sess
+                 LEFT JOIN paytag_item i ON i.session_id = sess.id
+                    {where}
+                  GROUP BY sess.id
+                   ) c
+             WHERE s.id = c.session_id
+               AND (s.items_count IS DISTINCT FROM c.total
+                    OR s.added_count IS DISTINCT FROM c.added
+                    OR s.removed_count IS DISTINCT FROM c.removed
+                    OR s.paid_count IS DISTINCT FROM c.paid
+                    OR s.unpaid_count IS DISTINCT FROM c.unpaid
+                    OR s.neutralized_count IS DISTINCT FROM c.neutralized)
+        """, [tuple(self.ids)] if self.ids else None)
+        self.invalidate_model(list(ITEM_STATUS_COUNTERS.values()) + ['items_count'])
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        sessions = super().create(vals_list)
+        sessions._update_active_session_cache()
+        return sessions
+
+    def write(self, vals):
+        if 'machine_ip' in vals:
+            ws_service = self.env['paytag.websocket.service']
+            for rec in self:
+                ws_service._forget_active_session(rec.machine_ip or ws_service._default_machine_ip(), rec.id)
+        res = super().write(vals)
+        if 'state' in vals or 'machine_ip' in vals:
+            self._update_active_session_cache()
+        return res
+
+    def _bump_change_seq(self, unlink=False):
+        """
+        Increment ``change_seq`` of the sessions and return ``{id: new value}``.
+
+        The row lock taken by the UPDATE is held until commit, so a client
+        that read cursor N can never miss a change numbered N or below.
+        """
+        if not self.ids:
+            return {}
+        if unlink:
+            self.env.cr.execute("""
+                UPDATE paytag_session
+                   SET change_seq = COALESCE(change_seq, 0) + 1, unlink_seq = COALESCE(change_seq, 0) + 1
+                 WHERE id IN %s
+             RETURNING id, change_seq
+            """, [tuple(self.ids)])
+        else:
+            self.env.cr.execute("""
+                UPDATE paytag_session SET change_seq = COALESCE(change_seq, 0) + 1
+                 WHERE id IN %s
+             RETURNING id, change_seq
+            """, [tuple(self.ids)])
+        seqs = dict(self.env.cr.fetchall())
+        self.invalidate_recordset(['change_seq', 'unlink_seq'])
+        return seqs
+
+    @api.model
+    def _apply_count_deltas(self, deltas):
+        """Apply ``{session_id: {status: delta}}`` to the stored item counters."""
+        for session_id, status_deltas in deltas.items():
+            assignments = []
+            params = []
+            total = sum(status_deltas.values())
+            if total:
+                assignments.append("items_count = COALESCE(items_count, 0) + %s")
+                params.append(total)
+            for status, delta in status_deltas.items():
+                if delta and status in ITEM_STATUS_COUNTERS:
+                    column = ITEM_STATUS_COUNTERS[status]
+                    assignments.append(f"{column} = COALESCE({column}, 0) + %s")
+                    params.append(delta)
+            if not assignments:
+                continue
+            self.env.cr.execute(
+                f"UPDATE paytag_session SET {', '.join(assignments)} WHERE id = %s",
+                params + [session_id],
+            )
+        if deltas:
+            self.browse(deltas).invalidate_recordset(list(ITEM_STATUS_COUNTERS.values()) + ['items_count'])
 
-    @api.depends('paytag_item_ids')
-    def _compute_items_count(self):
+    def _update_active_session_cache(self):
+        """Keep the websocket service's active session per machine in sync."""
+        ws_service = self.env['paytag.websocket.service']
         for rec in self:
-            rec.items_count = len(rec.paytag_item_ids)
+            machine_ip = rec.machine_ip or ws_service._default_machine_ip()
+            if rec.state in ACTIVE_SESSION_STATES:
+                # other workers must not see the session before it is committed
+                ws_service._remember_active_session_after_commit(self.env.cr, machine_ip, rec.id)
+            else:
+                ws_service._forget_active_session(machine_ip, rec.id)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import re
+import threading
+
+from odoo.tools import config
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_MAX_MB = 256
+
+
+class PaytagSpool(object):
+    """
+    Append-only spool of the frames of one machine that could not be
+    applied to the database yet, in ``<data_dir>/paytag_spool/<dbname>``.
+
+    Frames are appended as JSON lines and fsynced by batch; the byte offset
+    of the first frame not yet applied is kept in a ``.offset`` file next
+    to it. Once everything is applied both files are truncated. Appends
+    beyond ``max_bytes`` are refused so a long outage cannot fill the disk.
+
+    All methods block on disk I/O: call them from a worker thread.
+    """
+
+    def __init__(self, dbname, machine_ip, max_bytes=DEFAULT_SPOOL_MAX_MB * 1024 * 1024):
+        directory = os.path.join(config['data_dir'], 'paytag_spool', dbname)
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', machine_ip or 'default')
+        self.path = os.path.join(directory, f"{name}.jsonl")
+        self.offset_path = f"{self.path}.offset"
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = 0
+        self.offset = 0
+        self.frames = 0
+        self.oldest_ts = None
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Recover the unapplied frames left by a previous run."""
+        try:
+            self.size = os.path.getsize(self.path)
+        except OSError:
+            self.size = 0
+        try:
+            with open(self.offset_path) as offset_file:
+                self.offset = min(int(offset_file.read().strip() or 0), self.size)
+        except (OSError, ValueError):
+            self.offset = 0
+        if self.size > self.offset:
+            with open(self.path, 'rb') as spool:
+                spool.seek(self.offset)
+                for line in spool:
+                    if not line.endswith(b'\n'):
+                        # torn write at crash time, never fsynced as a whole
+                        self.size -= len(line)
+                        break
+                    if self.oldest_ts is None:
+                        self.oldest_ts = json.loads(line)['ts']
+                    self.frames += 1
+            _logger.warning("Paytag spool %s holds %d frames to apply", self.path, self.frames)
+
+    def append(self, entries):
+        """
+        Append ``(ts, frame)`` entries and fsync them once. Entries that
+        would make the spool exceed its size limit are dropped; return how
+        many were written.
+        """
+        data = []
+        written = 0
+        with self.lock:
+            size = self.size
+            for ts, frame in entries:
+                line = (json.dumps({'ts': ts, 'frame': frame}) + '\n').encode('utf-8')
+                if size + len(line) > self.max_bytes:
+                    self.dropped += 1
+                    continue
+                if self.frames + written == 0:
+                    self.oldest_ts = ts
+                data.append(line)
+                size += len(line)
+                written += 1
+            if data:
+                with open(self.path, 'ab') as spool:
+                    spool.truncate(self.size)
+                    spool.write(b''.join(data))
+                    spool.flush()
+                    os.fsync(spool.fileno())
+                self.size = size
+                self.frames += written
+        if written < len(entries):
+            _logger.error("Paytag spool %s is full: dropped %d frames", self.path, len(entries) - written)
+        return written
+
+    def read(self, limit):
+        """Return up to ``limit`` unapplied frames and the offset right after them."""
+        with self.lock:
+            if self.offset >= self.size:
+                return [], self.offset
+            frames = []
+            offset = self.offset
+            with open(self.path, 'rb') as spool:
+                spool.seek(offset)
+                while len(frames) < limit and offset < self.size:
+                    line = spool.readline()
+                    if not line:
+                        break
+                    offset += len(line)
+                    entry = json.loads(line)
+                    if not frames:
+                        self.oldest_ts = entry['ts']
+                    frames.append(entry['frame'])
+            return frames, offset
+
+    def commit(self, offset, count):
+        """Record the frames up to ``offset`` as applied, truncating an emptied spool."""
+        with self.lock:
+            self.offset = offset
+            self.frames = max(0, self.frames - count)
+            if self.offset >= self.size:
+                with open(self.path, 'wb'):
+                    pass
+                self.size = self.offset = self.frames = 0
+                self.oldest_ts = None
+            tmp_path = f"{self.offset_path}.tmp"
+            with open(tmp_path, 'w') as offset_file:
+                offset_file.write(str(self.offset))
+                offset_file.flush()
+                os.fsync(offset_file.fileno())
+            os.replace(tmp_path, self.offset_path)
+
+    def stats(self, now):
+        """Frames and bytes waiting, and the age in seconds of the oldest one."""
+        with self.lock:
+            return {
+                'frames': self.frames,
+                'bytes': self.size - self.offset,
+                'lag_seconds': max(0.0, now - self.oldest_ts) if self.frames and self.oldest_ts else 0.0,
+                'dropped': self.dropped,
+            }
@@ -1,11 +1,26 @@
 # -*- coding: utf-8 -*-
 import asyncio
+import concurrent.futures
+import heapq
+import itertools
 import json
+import os
+import random
+import select
 import threading
 import logging
+import time
+import uuid
+from collections import deque
 from datetime import datetime
+from functools import partial
+from urllib.parse import urlparse
 
-from odoo import models, fields, api, registry
+import psycopg2
+
+import odoo
+from odoo import models, api
+from odoo.tools import config
 
 # aiohttp is required
 try:
@@ -14,19 +29,286 @@ except Exception:
     ClientSession = None
     WSMsgType = None
 
+from .paytag_cursor_pool import DEFAULT_CURSOR_POOL_SIZE, PaytagCursorPool
+from .paytag_journal import DEFAULT_JOURNAL_DAYS, PaytagJournal
+from .paytag_notifier import NOTIFY_PAYLOAD_LIMIT
+from .paytag_spool import DEFAULT_SPOOL_MAX_MB, PaytagSpool
+from . import paytag_metrics as metrics
+from .paytag_session import ACTIVE_SESSION_STATES, NEUTRALIZER_SESSION_STATES
+
 _logger = logging.getLogger(__name__)
 
+DEFAULT_WS_URI = "ws://127.0.0.1:8765/ws"
+DEFAULT_WS_URI_TEMPLATE = "ws://{ip}:8765/ws"
+DEFAULT_INGEST_BATCH_SIZE = 200
+DEFAULT_INGEST_WINDOW_MS = 50
+DEFAULT_INGEST_WORKERS = 2
+# Barcode frames of a tag are held until it has been quiet for this long
+DEFAULT_DEBOUNCE_MS = 300
+# Frames waiting in memory for a worker before new ones are spooled to disk
+DEFAULT_SPOOL_BACKLOG = 4000
+# Spooled frames are fsynced together at most this often
+SPOOL_FSYNC_INTERVAL = 0.1
+# Retry delay of the spool drain while the database keeps failing
+SPOOL_RETRY_MAX_DELAY = 30
+# Item statuses a device snapshot may change; paid, unpaid and neutralized items are left alone
+PRESENCE_STATUSES = ('added', 'removed')
+# request_codes of the get_items sent to a machine, remembered to spot their snapshot replies
+SNAPSHOT_CODES_LIMIT = 100
+DEFAULT_REPLY_TIMEOUT_MS = 2000
+DEFAULT_COMMAND_QUEUE_SIZE = 100
+# Lower runs first: refreshes wait behind session commands, which stay in FIFO order
+# so a stop never overtakes the start it ends
+COMMAND_PRIORITIES = {'get_items': 1}
+DEFAULT_COMMAND_PRIORITY = 0
+
+# Only the process holding this PostgreSQL advisory lock talks to the devices
+LEADER_LOCK_KEY = 0x5061797461670001
+DEFAULT_LEADER_HEARTBEAT = 10
+# Minimum delay between two attempts of a follower to take the lead
+LEADER_RETRY_INTERVAL = 30
+# Followers forward commands to the leader, which answers on the reply channel
+COMMAND_CHANNEL = 'paytag_command'
+REPLY_CHANNEL = 'paytag_reply'
+# Seconds a follower waits for the leader to acknowledge forwarded commands
+FORWARD_ACK_TIMEOUT = 2.0
+
+# Seconds between websocket pings; a connection missing its pong is closed
+DEFAULT_WS_HEARTBEAT = 10
+# Reconnect backoff: first retry within RECONNECT_FIRST_DELAY, then doubling up to the max
+RECONNECT_FIRST_DELAY = 0.5
+RECONNECT_BASE_DELAY = 1.0
+DEFAULT_RECONNECT_MAX_DELAY = 60
+# A connection that lived this long resets the backoff
+RECONNECT_STABLE_AFTER = 30
+
+
+class PaytagQueueFull(Exception):
+    """Raised by send_command when a machine has too many pending commands."""
+
+
+class PaytagUnknownMachine(Exception):
+    """Raised by send_command for a machine that is not listed in ``paytag.machines``."""
+
+
+class PaytagCommandQueue(object):
+    """
+    Bounded priority queue of the commands waiting for one machine.
+
+    ``put`` never blocks and may be called from any thread; ``get`` is
+    awaited by the machine's sender on the service loop. A ``get_items``
+    queued while another one is still waiting is merged into it.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.heap = []
+        self.counter = itertools.count()
+        # request_code of the get_items still waiting in the queue, if any
+        self.pending_get_items = None
+        # set by start() on the service loop
+        self.loop = None
+        self.ready = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Event()
+        if self.heap:
+            self.ready.set()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, command):
+        """
+        Queue ``command`` and return ``(status, request_code)`` where status
+        is 'queued', 'coalesced' (request_code is then the one of the queued
+        get_items answering for it) or 'full'.
+        """
+        name = command.get('command')
+        with self.lock:
+            if name == 'get_items' and self.pending_get_items is not None:
+                return 'coalesced', self.pending_get_items
+            if len(self.heap) >= self.maxsize:
+                return 'full', command.get('request_code')
+            priority = COMMAND_PRIORITIES.get(name, DEFAULT_COMMAND_PRIORITY)
+            heapq.heappush(self.heap, (priority, next(self.counter), command))
+            if name == 'get_items':
+                self.pending_get_items = command.get('request_code') or ''
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        return 'queued', command.get('request_code')
+
+    async def get(self):
+        while True:
+            with self.lock:
+                if self.heap:
+                    command = heapq.heappop(self.heap)[2]
+                    if command.get('command') == 'get_items':
+                        self.pending_get_items = None
+                    return command
+                # puts from other threads set the event through the loop, after this
+                self.ready.clear()
+            await self.ready.wait()
+
+
+class PaytagMachine(object):
+    """
+    Connection state of one Paytag device. Every machine gets its own send
+    queue, ingestion buffer and reconnect state, all living on the shared
+    event loop of the service thread.
+    """
+
+    def __init__(self, machine_ip, uri, queue_size=DEFAULT_COMMAND_QUEUE_SIZE):
+        self.machine_ip = machine_ip
+        self.uri = uri
+        self.commands = PaytagCommandQueue(queue_size)
+        # asyncio primitives are created by start() on the service loop
+        self.ingest_buffer = []
+        self.ingest_pending = None
+        self.ingest_full = None
+        self.task = None
+        self.connected = False
+        # 'connecting', 'connected' or 'disconnected', see _set_machine_state
+        self.state = 'disconnected'
+        self.state_since = time.time()
+        self.last_frame_at = None
+        self.last_error = None
+        # consecutive failed or short-lived connections, drives the backoff
+        self.failures = 0
+        # debounce stage, see PaytagWebsocketService._debounce_payload
+        self.debounce_pending = {}   # tag key -> [last payload, deadline]
+        self.debounce_timer = None
+        self.suppressed = 0
+        # request_codes of the get_items commands sent, oldest first
+        self.snapshot_codes = deque(maxlen=SNAPSHOT_CODES_LIMIT)
+        # disk spool used while the database fails or falls behind, see _spool_payload
+        self.spool = None
+        self.spooling = False
+        self.spool_buffer = []       # (ts, frame) waiting for the next fsync
+        self.spool_writing = False
+        self.spool_written = None
+        self.spool_ready = None
+        # set while no flusher batch is being applied; spooled frames wait for it
+        self.ingest_idle = None
+
+    def reconnect_delay(self, max_delay=DEFAULT_RECONNECT_MAX_DELAY):
+        """Jittered exponential backoff, so a fleet of lanes does not reconnect in lockstep."""
+        if self.failures <= 1:
+            return random.uniform(0, RECONNECT_FIRST_DELAY)
+        delay = min(max_delay, RECONNECT_BASE_DELAY * 2 ** (self.failures - 2))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def start(self, service):
+        self.commands.start()
+        self.ingest_pending = asyncio.Event()
+        self.ingest_full = asyncio.Event()
+        self.spool_written = asyncio.Event()
+        self.spool_ready = asyncio.Event()
+        self.ingest_idle = asyncio.Event()
+        self.ingest_idle.set()
+        self.spool = PaytagSpool(
+            PaytagWebsocketService._dbname, self.machine_ip, PaytagWebsocketService._spool_max_bytes)
+        if self.spool.frames:
+            # frames left by a previous run go first
+            self.spooling = True
+            self.spool_ready.set()
+        self.task = asyncio.get_running_loop().create_task(service._run_machine(self))
+
+
+def _machine_gauge(read):
+    """Scrape-time gauge callback reading ``read(machine)`` for every machine."""
+    def callback():
+        with PaytagWebsocketService._machines_lock:
+            machines = list(PaytagWebsocketService._machines.values())
+        return {(machine.machine_ip,): read(machine) for machine in machines}
+    return callback
+
+
+metrics.REGISTRY.gauge(
+    'paytag_ws_connected', "1 while the websocket to a machine is open.", ('machine',),
+    callback=_machine_gauge(lambda machine: int(machine.connected)))
+metrics.REGISTRY.gauge(
+    'paytag_command_queue_depth', "Commands waiting to be sent to a machine.", ('machine',),
+    callback=_machine_gauge(lambda machine: len(machine.commands)))
+metrics.REGISTRY.gauge(
+    'paytag_ingest_buffered_frames', "Frames received from a machine and not yet handed to a worker.", ('machine',),
+    callback=_machine_gauge(lambda machine: len(machine.ingest_buffer)))
+metrics.REGISTRY.gauge(
+    'paytag_spool_frames', "Frames of a machine waiting in its disk spool.", ('machine',),
+    callback=_machine_gauge(lambda machine: machine.spool.frames if machine.spool else 0))
+metrics.REGISTRY.gauge(
+    'paytag_spool_bytes', "Disk used by the unapplied frames of a machine's spool.", ('machine',),
+    callback=_machine_gauge(lambda machine: machine.spool.stats(time.time())['bytes'] if machine.spool else 0))
+metrics.REGISTRY.gauge(
+    'paytag_spool_lag_seconds', "Age of the oldest frame waiting in a machine's spool.", ('machine',),
+    callback=_machine_gauge(lambda machine: machine.spool.stats(time.time())['lag_seconds'] if machine.spool else 0))
+metrics.REGISTRY.gauge(
+    'paytag_ingest_queued_batches', "Ingestion batches waiting for a free worker.",
+    callback=lambda: {(): PaytagWebsocketService._ingest_stats['queued']})
+metrics.REGISTRY.gauge(
+    'paytag_leader', "1 in the process that owns the device connections.",
+    callback=lambda: {(): int(bool(PaytagWebsocketService._thread and PaytagWebsocketService._thread.is_alive()))})
+# Metrics about the process itself, left out of the snapshot the leader publishes to the other workers
+PROCESS_METRICS = (metrics.HTTP_REQUESTS.name, metrics.HTTP_LATENCY.name, 'paytag_leader')
+
+
 class PaytagWebsocketService(models.AbstractModel):
     _name = 'paytag.websocket.service'
     _description = 'Paytag Websocket Service'
 
-    # Configuration stored in system parameters would be cleaner; for now simple default
-    ws_uri = fields.Char(string="Websocket URI", default="ws://127.0.0.1:8765/ws")
-
     _thread = None
     _loop = None
     _stop_event = None
-    _send_queue = None
+    _dbname = None
+    # Cursors used by the service thread for its own transactions
+    _cursor_pool = None
+    # Threads running the ORM work, so the event loop only does I/O
+    _executor = None
+
+    # Leader election: cursor holding the advisory lock, owned by the loop once started
+    _leader_cr = None
+    _leader_attempt_at = None
+    _leader_heartbeat = DEFAULT_LEADER_HEARTBEAT
+    # Forwarded commands awaiting a reply:
+    # (machine_ip, request_code) -> (monotonic deadline, request codes of the followers to answer)
+    _forwarded_replies = {}
+
+    # Connected devices: machine_ip -> PaytagMachine
+    _machines = {}
+    _machines_lock = threading.Lock()
+    # The only machines the leader connects to: machine_ip -> uri, from paytag.machines
+    _allowed_machines = {}
+    _ws_uri_template = DEFAULT_WS_URI_TEMPLATE
+    _ws_heartbeat = DEFAULT_WS_HEARTBEAT
+    _reconnect_max_delay = DEFAULT_RECONNECT_MAX_DELAY
+    # Connection state published by the leader, and the last one read by followers
+    _connection_state = {}
+    _connection_state_read = (None, {})
+    _command_queue_size = DEFAULT_COMMAND_QUEUE_SIZE
+
+    # Ingestion: parsed payloads are applied in one transaction per batch
+    _ingest_batch_size = DEFAULT_INGEST_BATCH_SIZE
+    _debounce_window = DEFAULT_DEBOUNCE_MS / 1000.0
+    _spool_backlog = DEFAULT_SPOOL_BACKLOG
+    _spool_max_bytes = DEFAULT_SPOOL_MAX_MB * 1024 * 1024
+    _ingest_window = DEFAULT_INGEST_WINDOW_MS / 1000.0
+    # Batches handed to the executor and not started yet, and their wait time
+    _ingest_stats = {'queued': 0, 'max_queued': 0, 'batches': 0, 'wait_ms_total': 0.0, 'wait_ms_max': 0.0}
+    _ingest_stats_lock = threading.Lock()
+    # Raw frame journal, None when paytag.journal is disabled
+    _journal = None
+
+    # Active session per machine: machine_ip -> (session_id, monotonic time it was confirmed)
+    _active_sessions = {}
+    _active_sessions_lock = threading.RLock()
+    # machine_ip -> number of forgets, so a remember scheduled before one is dropped
+    _active_session_generations = {}
+
+    # Commands waiting for the device's answer: (machine_ip, request_code) -> concurrent Future
+    _pending_replies = {}
+    _pending_replies_lock = threading.Lock()
 
     @api.model
     def ensure_running(self):
@@ -38,267 +320,1461 @@ class PaytagWebsocketService(models.AbstractModel):
         if PaytagWebsocketService._thread and PaytagWebsocketService._thread.is_alive():
             return True
 
-        PaytagWebsocketService._stop_event = threading.Event()
-        PaytagWebsocketService._send_queue = asyncio.Queue()
+        # In multi-worker deployments only one process may own the devices
+        if not self._acquire_leadership():
+            return False
+
+        # left over by a previous run, which already shut them down
+        PaytagWebsocketService._executor = PaytagWebsocketService._cursor_pool = None
+        try:
+            ICP = self.env['ir.config_parameter'].sudo()
+            PaytagWebsocketService._dbname = self.env.cr.dbname
+            PaytagWebsocketService._leader_heartbeat = max(
+                1, int(ICP.get_param('paytag.leader_heartbeat', DEFAULT_LEADER_HEARTBEAT)))
+            PaytagWebsocketService._ws_uri_template = ICP.get_param('paytag.ws_uri_template', DEFAULT_WS_URI_TEMPLATE)
+            PaytagWebsocketService._ws_heartbeat = max(
+                0, float(ICP.get_param('paytag.ws_heartbeat', DEFAULT_WS_HEARTBEAT)))
+            PaytagWebsocketService._reconnect_max_delay = max(
+                1, float(ICP.get_param('paytag.reconnect_max_delay', DEFAULT_RECONNECT_MAX_DELAY)))
+            PaytagWebsocketService._command_queue_size = max(
+                1, int(ICP.get_param('paytag.command_queue_size', DEFAULT_COMMAND_QUEUE_SIZE)))
+            PaytagWebsocketService._ingest_batch_size = max(
+                1, int(ICP.get_param('paytag.ingest_batch_size', DEFAULT_INGEST_BATCH_SIZE)))
+            PaytagWebsocketService._ingest_window = max(
+                0, int(ICP.get_param('paytag.ingest_window_ms', DEFAULT_INGEST_WINDOW_MS))) / 1000.0
+            PaytagWebsocketService._debounce_window = max(
+                0, int(ICP.get_param('paytag.debounce_ms', DEFAULT_DEBOUNCE_MS))) / 1000.0
+            PaytagWebsocketService._spool_backlog = max(
+                1, int(ICP.get_param('paytag.spool_backlog', DEFAULT_SPOOL_BACKLOG)))
+            PaytagWebsocketService._spool_max_bytes = max(
+                1, int(ICP.get_param('paytag.spool_max_mb', DEFAULT_SPOOL_MAX_MB))) * 1024 * 1024
+
+            if ICP.get_param('paytag.product_index_warm'):
+                self.env['product.product']._paytag_warm_product_index()
+
+            machines = self._configured_machines()
+            PaytagWebsocketService._allowed_machines = dict(machines)
+
+            if ICP.get_param('paytag.journal', '1') not in ('0', 'false', 'False'):
+                PaytagWebsocketService._journal = PaytagJournal(
+                    self.env.cr.dbname, max(0, int(ICP.get_param('paytag.journal_days', DEFAULT_JOURNAL_DAYS))))
+            else:
+                PaytagWebsocketService._journal = None
 
-        def run_loop():
+            workers = max(1, int(ICP.get_param('paytag.ingest_workers', DEFAULT_INGEST_WORKERS)))
+            PaytagWebsocketService._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='paytag-ingest')
+            # every worker thread needs a cursor of its own
+            PaytagWebsocketService._cursor_pool = PaytagCursorPool(
+                self.env.cr.dbname, max(workers, int(ICP.get_param('paytag.cursor_pool_size', DEFAULT_CURSOR_POOL_SIZE))))
+            PaytagWebsocketService._stop_event = threading.Event()
+            PaytagWebsocketService._machines = {}
             loop = asyncio.new_event_loop()
             PaytagWebsocketService._loop = loop
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                try:
+                    loop.run_until_complete(self._run_forever(machines))
+                except Exception as e:
+                    _logger.exception("Websocket loop exception: %s", e)
+                finally:
+                    PaytagWebsocketService._executor.shutdown(wait=True)
+                    if PaytagWebsocketService._journal:
+                        PaytagWebsocketService._journal.flush()
+                    PaytagWebsocketService._cursor_pool.close()
+                    self._publish_connection_state(stopped=True)
+                    self._release_leadership()
+                    loop.close()
+            PaytagWebsocketService._thread = threading.Thread(target=run_loop, daemon=True, name="paytag-ws")
+            PaytagWebsocketService._thread.start()
+            _logger.info("Started Paytag websocket thread for %d machine(s)", len(machines))
+        except Exception:
+            # without a thread nobody would ever release the lock and the cluster would stay leaderless
+            _logger.exception("Could not start the Paytag websocket service")
+            if PaytagWebsocketService._executor is not None:
+                PaytagWebsocketService._executor.shutdown(wait=False)
+                PaytagWebsocketService._executor = None
+            if PaytagWebsocketService._cursor_pool is not None:
+                PaytagWebsocketService._cursor_pool.close()
+                PaytagWebsocketService._cursor_pool = None
+            self._release_leadership()
+            raise
+        return True
+
+    # ------------- Leader election -------------
+
+    @api.model
+    def _acquire_leadership(self):
+        """
+        Try to take the cluster-wide advisory lock on a dedicated connection.
+        The lock lives as long as that connection, so it is released when
+        the leader stops or its process dies.
+        """
+        now = time.monotonic()
+        last_attempt = PaytagWebsocketService._leader_attempt_at
+        if last_attempt is not None and now - last_attempt < LEADER_RETRY_INTERVAL:
+            return False
+        PaytagWebsocketService._leader_attempt_at = now
+
+        cr = odoo.sql_db.db_connect(self.env.cr.dbname).cursor()
+        try:
+            cr.execute("SELECT pg_try_advisory_lock(%s)", [LEADER_LOCK_KEY])
+            if not cr.fetchone()[0]:
+                cr.close()
+                _logger.debug("Another process owns the Paytag devices")
+                return False
+            cr.execute(f"LISTEN {COMMAND_CHANNEL}")
+            cr.commit()
+        except Exception:
+            cr.close()
+            raise
+        PaytagWebsocketService._leader_cr = cr
+        _logger.info("This process is now the Paytag websocket leader")
+        return True
+
+    def _release_leadership(self):
+        cr = PaytagWebsocketService._leader_cr
+        PaytagWebsocketService._leader_cr = None
+        PaytagWebsocketService._leader_attempt_at = None
+        if cr is None:
+            return
+        try:
+            # the connection goes back to the pool, do not leave the lock on it
+            cr.execute(f"UNLISTEN {COMMAND_CHANNEL}")
+            cr.execute("SELECT pg_advisory_unlock(%s)", [LEADER_LOCK_KEY])
+            cr.commit()
+        except Exception:
+            _logger.warning("Could not release the Paytag leader lock cleanly", exc_info=True)
+        finally:
+            cr.close()
+        _logger.info("Released Paytag websocket leadership")
+
+    async def _hold_leadership(self):
+        """
+        Read forwarded commands from the leader connection and check it with
+        a heartbeat; if the connection dies the lock is gone, so stop the
+        service and let another worker take over.
+        """
+        cr = PaytagWebsocketService._leader_cr
+        conn = cr._cnx
+        loop = asyncio.get_running_loop()
+        loop.add_reader(conn.fileno(), self._read_forwarded_commands, conn)
+        try:
+            while True:
+                await asyncio.sleep(PaytagWebsocketService._leader_heartbeat)
+                try:
+                    # machines added to paytag.machines meanwhile become usable
+                    cr.execute("SELECT value FROM ir_config_parameter WHERE key = 'paytag.machines'")
+                    row = cr.fetchone()
+                    cr.commit()
+                except Exception:
+                    _logger.exception("Paytag leader connection lost, stopping the service")
+                    PaytagWebsocketService._stop_event.set()
+                    return
+                PaytagWebsocketService._allowed_machines = self._parse_machines(row and row[0])
+                self._read_forwarded_commands(conn)
+                # refresh the state file so followers know the leader is alive
+                self._publish_connection_state()
+                self._publish_metrics()
+                now = time.monotonic()
+                for key, (deadline, _codes) in list(PaytagWebsocketService._forwarded_replies.items()):
+                    if deadline < now:
+                        del PaytagWebsocketService._forwarded_replies[key]
+        finally:
+            loop.remove_reader(conn.fileno())
+
+    def _read_forwarded_commands(self, conn):
+        """
+        Queue the commands other workers sent on the command channel and
+        acknowledge each with its queue status on the reply channel (runs on
+        the loop).
+        """
+        try:
+            conn.poll()
+        except Exception:
+            _logger.exception("Failed to poll the Paytag leader connection")
+            return
+        acks = []
+        while conn.notifies:
+            notify = conn.notifies.pop(0)
+            if notify.channel != COMMAND_CHANNEL:
+                continue
             try:
-                loop.run_until_complete(self._run_forever())
-            except Exception as e:
-                _logger.exception("Websocket loop exception: %s", e)
-            finally:
-                loop.close()
-        PaytagWebsocketService._thread = threading.Thread(target=run_loop, daemon=True, name="paytag-ws")
-        PaytagWebsocketService._thread.start()
-        _logger.info("Started Paytag websocket thread")
+                message = json.loads(notify.payload)
+                command = message['command']
+                request_code = command.get('request_code')
+                machine = self._get_machine(message['machine_ip'])
+                if machine is None:
+                    status, queued_code = 'unknown', request_code
+                else:
+                    status, queued_code = machine.commands.put(command)
+                _logger.debug("Forwarded command for Paytag %s %s: %s", message['machine_ip'], status, command)
+                if message.get('forward_id'):
+                    acks.append({'ack': message['forward_id'], 'status': status})
+                if status in ('full', 'unknown') or not (message.get('wait_ms') and request_code):
+                    continue
+                deadline = time.monotonic() + message['wait_ms'] / 1000.0
+                key = (machine.machine_ip, queued_code)
+                previous_deadline, codes = PaytagWebsocketService._forwarded_replies.get(key, (0, set()))
+                codes.add(request_code)
+                PaytagWebsocketService._forwarded_replies[key] = (max(deadline, previous_deadline), codes)
+            except Exception:
+                _logger.exception("Invalid forwarded Paytag command: %s", notify.payload)
+        if acks:
+            self._notify_replies(acks)
+
+    def _forward_reply(self, machine_ip, payload):
+        """Send a reply of ``machine_ip`` to the followers waiting for it (runs on the loop)."""
+        request_code = payload.get('request_code')
+        entry = PaytagWebsocketService._forwarded_replies.pop((machine_ip, request_code), None)
+        if entry is None:
+            return False
+        # coalesced get_items are answered under the follower's own request_code
+        return self._notify_replies([
+            {'machine_ip': machine_ip,
+             'reply': payload if code == request_code
+             else dict(payload, request_code=code, coalesced_into=request_code)}
+            for code in entry[1]
+        ])
+
+    def _notify_replies(self, payloads):
+        """Publish replies and acks on the reply channel of the leader connection, in one transaction (runs on the loop)."""
+        cr = PaytagWebsocketService._leader_cr
+        try:
+            for payload in payloads:
+                message = json.dumps(payload)
+                if len(message) > NOTIFY_PAYLOAD_LIMIT:
+                    # keep the scalar fields of the reply so the caller still gets the outcome
+                    message = json.dumps(dict(payload, reply=dict(
+                        {k: v for k, v in payload['reply'].items() if not isinstance(v, (list, dict))},
+                        truncated=True,
+                    )))
+                cr.execute("SELECT pg_notify(%s, %s)", [REPLY_CHANNEL, message])
+            cr.commit()
+        except Exception:
+            _logger.exception("Failed to send %d Paytag replies to the followers", len(payloads))
+            return False
         return True
 
-    async def _run_forever(self):
-        """Main async loop for websocket connection & handling."""
-        uri = self.ws_uri or "ws://127.0.0.1:8765/ws"
-        retry_delay = 5
+    @api.model
+    def _forward_command(self, command_dict, machine_ip, wait_ms=None):
+        """
+        Hand a command to the leader process over NOTIFY and, with
+        ``wait_ms``, wait for the leader to send the device's reply back.
+        Same return values and exceptions as send_command.
+        """
+        wait = bool(wait_ms and command_dict.get('request_code'))
+        reply, statuses = self._forward_commands([(machine_ip, command_dict)], wait_ms=wait_ms)
+        if statuses[0] == 'full':
+            raise PaytagQueueFull(machine_ip)
+        if statuses[0] == 'unknown':
+            raise PaytagUnknownMachine(machine_ip)
+        if statuses[0] is None:
+            return None if wait else False
+        return reply if wait else True
+
+    @api.model
+    def _forward_commands(self, commands, wait_ms=None):
+        """
+        Hand ``(machine_ip, command)`` pairs to the leader process over
+        NOTIFY, in order, wait up to ``FORWARD_ACK_TIMEOUT`` for the leader
+        to acknowledge them and, with ``wait_ms``, up to that long for the
+        device's reply to the first one.
+
+        Return ``(reply, statuses)`` with one queue status per command:
+        'queued', 'coalesced', 'full', 'unknown', or None when the command
+        did not reach a leader or was not acknowledged in time.
+        """
+        machine_ip, first = commands[0]
+        request_code = first.get('request_code')
+        wait = bool(wait_ms and request_code)
+        statuses = [None] * len(commands)
+        messages = []
+        # forward_id -> index of the command awaiting its ack
+        unacked = {}
+        for index, (command_ip, command) in enumerate(commands):
+            forward_id = uuid.uuid4().hex
+            message = json.dumps({'machine_ip': command_ip, 'command': command, 'forward_id': forward_id,
+                                  'wait_ms': wait_ms if wait and index == 0 else 0})
+            if len(message) > NOTIFY_PAYLOAD_LIMIT:
+                _logger.error("Paytag command too large to forward to the leader (%d bytes)", len(message))
+                if index == 0:
+                    wait = False
+                continue
+            messages.append(message)
+            unacked[forward_id] = index
+        if not messages:
+            return None, statuses
+        with odoo.sql_db.db_connect(self.env.cr.dbname).cursor() as cr:
+            cr.execute("SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND granted"
+                       " AND ((classid::bigint << 32) | objid::bigint) = %s", [LEADER_LOCK_KEY])
+            if not cr.fetchone():
+                _logger.warning("No Paytag websocket leader running; cannot send command.")
+                return None, statuses
+            cr.execute(f"LISTEN {REPLY_CHANNEL}")
+            for message in messages:
+                # notifications of one transaction are delivered in order
+                cr.execute("SELECT pg_notify(%s, %s)", [COMMAND_CHANNEL, message])
+            cr.commit()
+            _logger.debug("Forwarded %d commands to the Paytag leader", len(messages))
+            conn = cr._cnx
+            started = time.monotonic()
+            ack_deadline = started + FORWARD_ACK_TIMEOUT
+            reply_deadline = started + wait_ms / 1000.0 if wait else None
+            reply = None
+            try:
+                while True:
+                    now = time.monotonic()
+                    if unacked and now >= ack_deadline:
+                        _logger.warning("The Paytag leader did not acknowledge %d forwarded commands", len(unacked))
+                        unacked.clear()
+                    if statuses[0] not in ('queued', 'coalesced') and 0 not in unacked.values():
+                        # the first command was refused, no reply will come
+                        wait = False
+                    waiting = []
+                    if unacked:
+                        waiting.append(ack_deadline)
+                    if wait and reply is None:
+                        if now >= reply_deadline:
+                            _logger.info("No Paytag reply for request %s within %d ms", request_code, wait_ms)
+                            wait = False
+                        else:
+                            waiting.append(reply_deadline)
+                    if not waiting:
+                        return reply, statuses
+                    if select.select([conn], [], [], min(waiting) - now) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        message = json.loads(conn.notifies.pop(0).payload)
+                        if 'ack' in message:
+                            index = unacked.pop(message['ack'], None)
+                            if index is not None:
+                                statuses[index] = message.get('status')
+                        elif wait and reply is None and message.get('machine_ip') == machine_ip \
+                                and message['reply'].get('request_code') == request_code:
+                            reply = message['reply']
+            finally:
+                cr.execute(f"UNLISTEN {REPLY_CHANNEL}")
+                cr.commit()
+
+    # ------------- Machines -------------
+
+    @api.model
+    def _machine_uri(self, machine_ip):
+        """Websocket URI of a ``paytag.machines`` entry given by its IP (or by a full URI)."""
+        if '://' in machine_ip:
+            return machine_ip
+        return PaytagWebsocketService._ws_uri_template.format(ip=machine_ip)
+
+    @api.model
+    def _configured_machines(self):
+        """
+        Return ``{machine_ip: uri}`` from the ``paytag.machines`` parameter, a
+        comma separated list of IPs or websocket URIs. The first one is the
+        default machine. These are the only machines commands may target.
+        """
+        return self._parse_machines(self.env['ir.config_parameter'].sudo().get_param('paytag.machines'))
+
+    def _parse_machines(self, value):
+        """``{machine_ip: uri}`` of a ``paytag.machines`` value (runs on any thread)."""
+        machines = {}
+        for entry in (value or DEFAULT_WS_URI).split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            uri = self._machine_uri(entry)
+            machines.setdefault(urlparse(uri).hostname or entry, uri)
+        return machines
+
+    def _get_machine(self, machine_ip, uri=None):
+        """
+        Return the machine of ``machine_ip``, connecting it if needed (any
+        thread). None for a machine that is not configured: request bodies
+        must never make the server connect to arbitrary hosts.
+        """
+        with PaytagWebsocketService._machines_lock:
+            machine = PaytagWebsocketService._machines.get(machine_ip)
+            if machine is None:
+                uri = uri or PaytagWebsocketService._allowed_machines.get(machine_ip)
+                if not uri:
+                    _logger.warning("Refused command for unknown Paytag machine %r", machine_ip)
+                    return None
+                machine = PaytagMachine(
+                    machine_ip, uri, PaytagWebsocketService._command_queue_size)
+                PaytagWebsocketService._machines[machine_ip] = machine
+                PaytagWebsocketService._loop.call_soon_threadsafe(machine.start, self)
+                _logger.info("Registered Paytag machine %s (%s)", machine_ip, machine.uri)
+        return machine
+
+    async def _run_forever(self, machines):
+        """Start one connection task per machine and wait for the stop signal."""
+        for machine_ip, uri in machines.items():
+            self._get_machine(machine_ip, uri)
+        leader_task = asyncio.create_task(self._hold_leadership())
         while not PaytagWebsocketService._stop_event.is_set():
+            await asyncio.sleep(1)
+        leader_task.cancel()
+        running = [m for m in PaytagWebsocketService._machines.values() if m.task]
+        for machine in running:
+            machine.task.cancel()
+        await asyncio.gather(*(m.task for m in running), return_exceptions=True)
+        # Do not lose frames that were buffered when the service was stopped
+        for machine in running:
+            self._debounce_release(machine, force=True)
+            if machine.ingest_buffer:
+                batch, machine.ingest_buffer = machine.ingest_buffer, []
+                if self._flush_batch(machine.machine_ip, batch) is None:
+                    machine.spool_buffer.extend((time.time(), frame) for frame in batch)
+            if machine.spool_buffer:
+                # the drain of the next run applies them
+                entries, machine.spool_buffer = machine.spool_buffer, []
+                machine.spool.append(entries)
+
+    async def _run_machine(self, machine):
+        """
+        Connection loop of one machine: connect, send & receive, reconnect.
+
+        Pings every ``paytag.ws_heartbeat`` seconds close a connection whose
+        device stopped answering, instead of waiting on a half-open socket.
+        Reconnects back off exponentially with jitter after a fast first retry.
+        """
+        flush_task = asyncio.create_task(self._flusher(machine))
+        spool_tasks = [
+            asyncio.create_task(self._spool_writer(machine)),
+            asyncio.create_task(self._spool_drainer(machine)),
+        ]
+        heartbeat = PaytagWebsocketService._ws_heartbeat or None
+        try:
+            while not PaytagWebsocketService._stop_event.is_set():
+                connected_at = None
+                try:
+                    self._set_machine_state(machine, 'connecting')
+                    async with ClientSession() as session:
+                        _logger.info("Connecting to Paytag WS: %s", machine.uri)
+                        async with session.ws_connect(machine.uri, heartbeat=heartbeat) as ws:
+                            _logger.info("Connected to Paytag WS: %s", machine.uri)
+                            connected_at = time.monotonic()
+                            self._set_machine_state(machine, 'connected')
+                            metrics.WS_CONNECTS.inc(machine=machine.machine_ip)
+                            send_task = asyncio.create_task(self._sender(machine, ws))
+                            recv_task = asyncio.create_task(self._receiver(machine, ws))
+                            done, pending = await asyncio.wait([send_task, recv_task], return_when=asyncio.FIRST_COMPLETED)
+                            for t in pending:
+                                t.cancel()
+                            close_code = ws.close_code
+                    metrics.WS_DISCONNECTS.inc(machine=machine.machine_ip, reason='closed')
+                    self._set_machine_state(machine, 'disconnected', f"Connection closed (code {close_code})")
+                except asyncio.CancelledError:
+                    self._set_machine_state(machine, 'disconnected')
+                    raise
+                except Exception as e:
+                    _logger.exception("Error in websocket connection to %s: %s", machine.uri, e)
+                    metrics.WS_DISCONNECTS.inc(machine=machine.machine_ip, reason='error')
+                    self._set_machine_state(machine, 'disconnected', str(e) or type(e).__name__)
+                if connected_at is not None and time.monotonic() - connected_at >= RECONNECT_STABLE_AFTER:
+                    machine.failures = 0
+                machine.failures += 1
+                if not PaytagWebsocketService._stop_event.is_set():
+                    delay = machine.reconnect_delay(PaytagWebsocketService._reconnect_max_delay)
+                    _logger.info("Reconnecting to %s in %.1f s (attempt %d)", machine.uri, delay, machine.failures)
+                    await asyncio.sleep(delay)
+        finally:
+            flush_task.cancel()
+            for task in spool_tasks:
+                task.cancel()
+
+    # ------------- Connection state -------------
+
+    def _set_machine_state(self, machine, state, error=None):
+        """Record a connection state transition of a machine and publish it (runs on the loop)."""
+        if machine.state == state and not error:
+            return
+        machine.state = state
+        machine.connected = state == 'connected'
+        machine.state_since = time.time()
+        if error:
+            machine.last_error = error
+        self._publish_connection_state()
+
+    @staticmethod
+    def _connection_state_file(dbname):
+        return os.path.join(config['data_dir'], 'paytag_state', f"{dbname}.json")
+
+    def _publish_connection_state(self, stopped=False):
+        """
+        Publish the machines' connection state in memory, and in a file of
+        the data directory for the other workers of this server.
+        """
+        with PaytagWebsocketService._machines_lock:
+            machines = list(PaytagWebsocketService._machines.values())
+        state = {
+            'pid': os.getpid(),
+            'updated_at': time.time(),
+            # followers judge the file's freshness by the leader's heartbeat, not their own setting
+            'heartbeat': PaytagWebsocketService._leader_heartbeat,
+            'running': not stopped,
+            'machines': {
+                machine.machine_ip: {
+                    'state': 'disconnected' if stopped else machine.state,
+                    'connected': machine.connected and not stopped,
+                    'since': machine.state_since,
+                    'last_frame_at': machine.last_frame_at,
+                    'last_error': machine.last_error,
+                    'failures': machine.failures,
+                    'suppressed_events': machine.suppressed,
+                    'spool': dict(machine.spool.stats(time.time()), spooling=machine.spooling)
+                    if machine.spool else None,
+                    'queued_commands': len(machine.commands),
+                }
+                for machine in machines
+            },
+        }
+        PaytagWebsocketService._connection_state = state
+        self._write_state_file(self._connection_state_file(PaytagWebsocketService._dbname), state)
+
+    @staticmethod
+    def _metrics_file(dbname):
+        return os.path.join(config['data_dir'], 'paytag_state', f"{dbname}.metrics.json")
+
+    def _publish_metrics(self):
+        """Publish the leader's metrics in a file of the data directory, for /api/paytag/metrics of the other workers."""
+        self._write_state_file(self._metrics_file(PaytagWebsocketService._dbname), {
+            'pid': os.getpid(),
+            'updated_at': time.time(),
+            'heartbeat': PaytagWebsocketService._leader_heartbeat,
+            'metrics': metrics.REGISTRY.snapshot(exclude=PROCESS_METRICS),
+        })
+
+    @staticmethod
+    def _write_state_file(path, data):
+        """Replace ``path`` with ``data`` as JSON, atomically for the readers."""
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as state_file:
+                json.dump(data, state_file)
+            os.replace(tmp_path, path)
+        except OSError:
+            _logger.warning("Could not write the Paytag state file %s", path, exc_info=True)
+
+    @api.model
+    def leader_metrics(self):
+        """
+        Metrics snapshot published by the leader, or None in the leader
+        itself or when no leader refreshed it for three heartbeats.
+        """
+        if PaytagWebsocketService._thread and PaytagWebsocketService._thread.is_alive():
+            return None
+        try:
+            with open(self._metrics_file(self.env.cr.dbname)) as metrics_file:
+                published = json.load(metrics_file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - published.get('updated_at', 0) > 3 * published.get('heartbeat', DEFAULT_LEADER_HEARTBEAT):
+            return None
+        return published.get('metrics')
+
+    @api.model
+    def connection_state(self):
+        """
+        Connection state of the machines without touching the database: the
+        leader's own when this process is the leader, else the state file it
+        publishes. A file not refreshed for three heartbeats means no leader.
+        """
+        if PaytagWebsocketService._thread and PaytagWebsocketService._thread.is_alive():
+            return PaytagWebsocketService._connection_state
+        path = self._connection_state_file(self.env.cr.dbname)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return {'running': False, 'machines': {}}
+        cached_mtime, state = PaytagWebsocketService._connection_state_read
+        if mtime != cached_mtime:
             try:
-                async with ClientSession() as session:
-                    _logger.info("Connecting to Paytag WS: %s", uri)
-                    async with session.ws_connect(uri) as ws:
-                        _logger.info("Connected to Paytag WS")
-                        send_task = asyncio.create_task(self._sender(ws))
-                        recv_task = asyncio.create_task(self._receiver(ws))
-                        done, pending = await asyncio.wait([send_task, recv_task], return_when=asyncio.FIRST_EXCEPTION)
-                        for t in pending:
-                            t.cancel()
-            except Exception as e:
-                _logger.exception("Error in websocket connection: %s", e)
-                await asyncio.sleep(retry_delay)
+                with open(path) as state_file:
+                    state = json.load(state_file)
+            except (OSError, ValueError):
+                return {'running': False, 'machines': {}}
+            PaytagWebsocketService._connection_state_read = (mtime, state)
+        if time.time() - state.get('updated_at', 0) > 3 * state.get('heartbeat', DEFAULT_LEADER_HEARTBEAT):
+            return dict(state, running=False, machines={
+                machine_ip: dict(machine, state='unknown', connected=False)
+                for machine_ip, machine in state.get('machines', {}).items()
+            })
+        return state
+
+    @api.model
+    def machine_connected(self, machine_ip=None):
+        """Whether the websocket to ``machine_ip`` (default machine if not given) is open."""
+        machine_ip = machine_ip or self._default_machine_ip()
+        machine = self.connection_state().get('machines', {}).get(machine_ip)
+        return bool(machine and machine.get('connected'))
 
-    async def _sender(self, websocket):
+    async def _sender(self, machine, websocket):
         """Sends queued commands to the device. Queue items are dicts."""
         while not PaytagWebsocketService._stop_event.is_set():
             try:
-                cmd = await PaytagWebsocketService._send_queue.get()
+                cmd = await machine.commands.get()
                 if cmd is None:
                     continue
-                await websocket.send_json(cmd)
-                _logger.info("Sent to Paytag: %s", cmd)
+                with metrics.WS_SEND_LATENCY.time(machine=machine.machine_ip):
+                    await websocket.send_json(cmd)
+                metrics.WS_SENT.inc(machine=machine.machine_ip, command=cmd.get('command') or '')
+                if cmd.get('command') == 'get_items' and cmd.get('request_code'):
+                    machine.snapshot_codes.append(cmd['request_code'])
+                _logger.info("Sent to Paytag %s: %s", machine.machine_ip, cmd)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
+                metrics.WS_SEND_ERRORS.inc(machine=machine.machine_ip)
                 _logger.exception("Send error: %s", e)
                 await asyncio.sleep(1)
 
-    async def _receiver(self, websocket):
-        """Receive messages and write to Odoo models."""
+    async def _receiver(self, machine, websocket):
+        """Receive messages and buffer them for the machine's flusher."""
         async for message in websocket:
             try:
                 if message.type == WSMsgType.TEXT:
                     text = message.data
-                    _logger.debug("Received WS message: %s", text)
+                    _logger.debug("Received WS message from %s: %s", machine.machine_ip, text)
                     try:
                         payload = json.loads(text)
                     except Exception:
+                        metrics.WS_RECEIVE_ERRORS.inc(machine=machine.machine_ip)
                         _logger.warning("Non-json message: %s", text)
                         continue
-                    # Dispatch handling in Odoo environment
-                    self._handle_payload(payload)
+                    metrics.WS_RECEIVED.inc(machine=machine.machine_ip, type=payload.get('type') or 'other')
+                    machine.last_frame_at = time.time()
+                    if PaytagWebsocketService._journal:
+                        PaytagWebsocketService._journal.record(machine.machine_ip, text)
+                    if payload.get('request_code') in machine.snapshot_codes and 'command' not in payload:
+                        # mark the answer to our get_items as a basket snapshot
+                        payload['command'] = 'get_items'
+                    self._resolve_reply(machine.machine_ip, payload)
+                    self._forward_reply(machine.machine_ip, payload)
+                    self._debounce_payload(machine, payload)
                 elif message.type in (WSMsgType.CLOSED, WSMsgType.ERROR):
                     _logger.warning("WS closed or error: %s", message)
                     break
             except Exception as e:
+                metrics.WS_RECEIVE_ERRORS.inc(machine=machine.machine_ip)
                 _logger.exception("Receiver loop error: %s", e)
 
-    def _handle_payload(self, payload):
+    # ------------- Debounce -------------
+
+    def _debounce_payload(self, machine, payload):
         """
-        Called on WS messages (synchronously). Use registry to run inside ORM safely.
+        Hold ``barcode`` frames per tag (RFID, else barcode) until the tag has
+        been quiet for ``paytag.debounce_ms``, so antenna flapping like
+        added/removed/added reaches the database as its settled state only.
+        Other frames go straight to the ingestion buffer (runs on the loop).
         """
+        window = PaytagWebsocketService._debounce_window
+        item = payload.get('item') or {}
+        key = item.get('rfid') or item.get('barcode')
+        if self._is_snapshot(payload):
+            # the snapshot supersedes the held frames, which must be applied before it
+            self._debounce_release(machine, force=True)
+        if not window or payload.get('type') != 'barcode' or not key:
+            self._buffer_payload(machine, payload)
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + window
+        pending = machine.debounce_pending.get(key)
+        if pending is not None:
+            # superseded before it settled
+            machine.suppressed += 1
+            metrics.DEBOUNCE_SUPPRESSED.inc(machine=machine.machine_ip)
+            pending[0] = payload
+            pending[1] = deadline
+        else:
+            machine.debounce_pending[key] = [payload, deadline]
+        if machine.debounce_timer is None:
+            machine.debounce_timer = loop.call_at(deadline, self._debounce_release, machine)
+
+    def _debounce_release(self, machine, force=False):
+        """Hand the settled tags to ingestion and re-arm the timer for the others (runs on the loop)."""
+        if force and machine.debounce_timer is not None:
+            machine.debounce_timer.cancel()
+        machine.debounce_timer = None
+        if not machine.debounce_pending:
+            return
+        loop = asyncio.get_running_loop() if not force else None
+        now = loop.time() if loop else None
+        next_deadline = None
+        for key, (payload, deadline) in list(machine.debounce_pending.items()):
+            if not force and deadline > now:
+                next_deadline = deadline if next_deadline is None else min(next_deadline, deadline)
+                continue
+            del machine.debounce_pending[key]
+            self._buffer_payload(machine, payload)
+        if next_deadline is not None:
+            machine.debounce_timer = loop.call_at(next_deadline, self._debounce_release, machine)
+
+    # ------------- Batched ingestion -------------
+
+    def _buffer_payload(self, machine, payload):
+        """
+        Append a parsed frame to the machine's ingestion buffer, or to its
+        disk spool while the database is failing or behind (runs on the loop).
+        """
+        if machine.spooling:
+            self._spool_payload(machine, payload)
+            return
+        if len(machine.ingest_buffer) >= PaytagWebsocketService._spool_backlog and machine.spool:
+            _logger.warning("Paytag %s ingestion is %d frames behind, spooling to disk",
+                            machine.machine_ip, len(machine.ingest_buffer))
+            self._start_spooling(machine, [])
+            self._spool_payload(machine, payload)
+            return
+        machine.ingest_buffer.append(payload)
+        machine.ingest_pending.set()
+        if len(machine.ingest_buffer) >= PaytagWebsocketService._ingest_batch_size:
+            machine.ingest_full.set()
+
+    async def _flusher(self, machine):
+        """
+        Apply buffered frames once the batch is full or the window since the
+        first buffered frame has elapsed, whichever comes first.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await machine.ingest_pending.wait()
+            deadline = loop.time() + PaytagWebsocketService._ingest_window
+            try:
+                await asyncio.wait_for(machine.ingest_full.wait(), timeout=max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+            batch, machine.ingest_buffer = machine.ingest_buffer, []
+            machine.ingest_pending.clear()
+            machine.ingest_full.clear()
+            if batch:
+                # the next batch of this machine waits for this one: order is kept per session
+                machine.ingest_idle.clear()
+                try:
+                    result = await self._submit_batch(machine.machine_ip, batch)
+                    if result is None:
+                        # nothing reached the disk while the batch ran, so it still goes first
+                        _logger.warning("Paytag database unavailable, spooling frames of %s to disk",
+                                        machine.machine_ip)
+                        self._start_spooling(machine, batch)
+                finally:
+                    machine.ingest_idle.set()
+
+    # ------------- Disk spool -------------
+
+    def _start_spooling(self, machine, batch):
+        """
+        Send the frames of ``machine`` to its disk spool, starting with the
+        unapplied ``batch`` and the frames buffered after it (runs on the loop).
+
+        The spool has a single applier, the drainer: frames only reach the
+        disk once the flusher's batch in flight is done, and a batch that
+        failed is put in front of them, so frames are applied in order.
+        """
+        if not machine.spool:
+            return
+        pending, machine.ingest_buffer = machine.ingest_buffer, []
+        machine.ingest_pending.clear()
+        machine.ingest_full.clear()
+        machine.spooling = True
+        now = time.time()
+        machine.spool_buffer[:0] = [(now, frame) for frame in list(batch) + pending]
+        machine.spool_written.set()
+
+    def _spool_payload(self, machine, payload):
+        """Queue a frame for the next fsync of the machine's spool (runs on the loop)."""
+        machine.spool_buffer.append((time.time(), payload))
+        machine.spool_written.set()
+
+    async def _spool_writer(self, machine):
+        """Write spooled frames to disk, one fsync per ``SPOOL_FSYNC_INTERVAL``."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await machine.spool_written.wait()
+            await asyncio.sleep(SPOOL_FSYNC_INTERVAL)
+            # a failing batch in flight must be spooled before the frames received after it
+            await machine.ingest_idle.wait()
+            machine.spool_written.clear()
+            entries, machine.spool_buffer = machine.spool_buffer, []
+            if not entries:
+                continue
+            machine.spool_writing = True
+            try:
+                # not the ingestion executor: its workers may be stuck on the database
+                written = await loop.run_in_executor(None, machine.spool.append, entries)
+            except OSError:
+                _logger.exception("Could not spool %d frames of %s", len(entries), machine.machine_ip)
+                written = 0
+            finally:
+                machine.spool_writing = False
+            if written < len(entries):
+                metrics.SPOOL_DROPPED.inc(len(entries) - written, machine=machine.machine_ip)
+            machine.spool_ready.set()
+
+    async def _spool_drainer(self, machine):
+        """
+        Apply spooled frames in order, one ingestion batch at a time, and go
+        back to in-memory buffering once the spool is empty.
+        """
+        loop = asyncio.get_running_loop()
+        failures = 0
+        while True:
+            await machine.spool_ready.wait()
+            frames, offset = await loop.run_in_executor(
+                None, machine.spool.read, PaytagWebsocketService._ingest_batch_size)
+            if not frames:
+                if not machine.spool_buffer and not machine.spool_writing:
+                    machine.spooling = False
+                    machine.spool_ready.clear()
+                    _logger.info("Paytag spool of %s drained", machine.machine_ip)
+                else:
+                    # wait for the writer to fsync what is still in memory
+                    machine.spool_ready.clear()
+                continue
+            # never apply spooled frames next to a flusher batch
+            await machine.ingest_idle.wait()
+            result = await self._submit_batch(machine.machine_ip, frames)
+            if result is None:
+                failures += 1
+                await asyncio.sleep(min(SPOOL_RETRY_MAX_DELAY, 2 ** min(failures, 5) * 0.5))
+                continue
+            if result is False:
+                _logger.error("Dropping %d spooled frames of %s that cannot be applied", len(frames), machine.machine_ip)
+                metrics.SPOOL_DROPPED.inc(len(frames), machine=machine.machine_ip)
+            failures = 0
+            await loop.run_in_executor(None, machine.spool.commit, offset, len(frames))
+
+    async def _submit_batch(self, machine_ip, batch):
+        """Run ``_flush_batch`` on the executor and account for its wait in the queue."""
+        stats = PaytagWebsocketService._ingest_stats
+        with PaytagWebsocketService._ingest_stats_lock:
+            stats['queued'] += 1
+            stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+        submitted = time.monotonic()
+
+        def run():
+            wait_ms = (time.monotonic() - submitted) * 1000.0
+            with PaytagWebsocketService._ingest_stats_lock:
+                stats['queued'] -= 1
+                stats['batches'] += 1
+                stats['wait_ms_total'] += wait_ms
+                stats['wait_ms_max'] = max(stats['wait_ms_max'], wait_ms)
+            metrics.INGEST_WAIT_LATENCY.observe(wait_ms / 1000.0)
+            if wait_ms > 100:
+                _logger.info("Paytag batch from %s waited %.1f ms for an ingest worker", machine_ip, wait_ms)
+            if PaytagWebsocketService._journal:
+                # journal before applying, so frames of a failing batch can be replayed
+                PaytagWebsocketService._journal.flush()
+            return self._flush_batch(machine_ip, batch)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(PaytagWebsocketService._executor, run)
+
+    def _flush_batch(self, machine_ip, batch):
+        """
+        Apply a batch of payloads from one machine in a single transaction.
+        When the batch fails, apply it again frame by frame and drop only
+        the frames that fail on their own.
+
+        Return True when applied, None when the database is unavailable or
+        timed out (the batch can be retried as is) and False when the batch
+        could not be applied at all.
+        """
+        started = time.monotonic()
+        metrics.INGEST_FRAMES.inc(len(batch), machine=machine_ip)
         try:
-            env = api.Environment(self.env.cr, self.env.uid, self.env.context)
-        except Exception:
-            # If called from outside normal env, obtain a fresh environment
-            with registry(self.env.cr.dbname).cursor() as cr:
-                env = api.Environment(cr, 1, {})
+            with PaytagWebsocketService._cursor_pool.environment() as env:
+                self._process_batch(env, batch, machine_ip)
+        except Exception as e:
+            # the cached session may have been created by the rolled back transaction
+            self._forget_active_session(machine_ip)
+            if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                # connection lost, lock or statement timeout, serialization failure...
+                _logger.warning("Database unavailable for batch of %d payloads from %s: %s", len(batch), machine_ip, e)
+                metrics.INGEST_FLUSHES.inc(machine=machine_ip, result='unavailable')
+                return None
+            _logger.exception("Failed to process batch of %d payloads from %s, retrying frame by frame",
+                              len(batch), machine_ip)
+            result = self._flush_frames(machine_ip, batch)
+            metrics.INGEST_FLUSHES.inc(machine=machine_ip, result={
+                True: 'retried', None: 'unavailable', False: 'failed'}[result])
+            return result
+        metrics.INGEST_FLUSHES.inc(machine=machine_ip, result='ok')
+        metrics.INGEST_FLUSH_LATENCY.observe(time.monotonic() - started, machine=machine_ip)
+        _logger.info(
+            "Flushed %d Paytag frames from %s in %.1f ms",
+            len(batch), machine_ip, (time.monotonic() - started) * 1000.0,
+        )
+        return True
 
-        # Use a safe wrapper to avoid long locks on the main thread
+    def _flush_frames(self, machine_ip, batch):
+        """
+        Apply the frames of a failed batch one by one, each under a savepoint
+        of a single transaction, so a bad frame only loses itself. Same
+        return values as ``_flush_batch``.
+        """
+        dropped = 0
         try:
-            self._process_message(env, payload)
+            with PaytagWebsocketService._cursor_pool.environment() as env:
+                for payload in batch:
+                    try:
+                        with env.cr.savepoint():
+                            self._process_batch(env, [payload], machine_ip)
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                        raise
+                    except Exception:
+                        _logger.exception("Dropping Paytag frame from %s that cannot be applied: %s", machine_ip, payload)
+                        dropped += 1
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            _logger.warning("Database unavailable while retrying batch of %d payloads from %s: %s",
+                            len(batch), machine_ip, e)
+            self._forget_active_session(machine_ip)
+            return None
         except Exception:
-            _logger.exception("Failed to process payload: %s", payload)
-
-    # def _process_message(self, env, payload):
-    #     """
-    #     Parse payload and create/update session/items.
-    #     This will be executed inside a DB cursor context when invoked from the thread.
-    #     """
-    #     # Minimal routing based on document spec
-    #     # 1) ACTION barcode
-    #     if payload.get('type') == 'barcode':
-    #         action = payload.get('action')
-    #         item = payload.get('item') or {}
-    #         rfid = item.get('rfid') or ''
-    #         barcode = item.get('barcode') or ''
-    #         # Find active session or create one (simple logic: last session not done)
-    #         Session = env['paytag.session'].sudo()
-    #         session = Session.search([('state', 'in', ['waiting', 'scanning'])], limit=1, order='start_time desc')
-    #         if not session:
-    #             session = Session.create({'name': f"session-{datetime.now().strftime('%Y%m%d%H%M%S')}", 'state': 'scanning'})
-    #         # Create or update item
-    #         Item = env['paytag.item'].sudo()
-    #         existing = Item.search([('rfid', '=', rfid), ('session_id', '=', session.id)], limit=1) if rfid else Item.search([('barcode','=',barcode),('session_id','=',session.id)], limit=1)
-    #         vals = {
-    #             'rfid': rfid,
-    #             'barcode': barcode,
-    #             'status': 'added' if action == 'added' else 'removed',
-    #             'session_id': session.id,
-    #             'last_seen': fields.Datetime.now()
-    #         }
-    #         if existing:
-    #             existing.write(vals)
-    #         else:
-    #             vals['first_seen'] = fields.Datetime.now()
-    #             Item.create(vals)
-    #         # Update session state
-    #         if session.state != 'scanning':
-    #             session.sudo().write({'state': 'scanning'})
-    #         _logger.info("Processed barcode action: %s (rfid=%s barcode=%s)", action, rfid, barcode)
-
-    #     # 2) Neutralizer type action
-    #     elif payload.get('type') == 'neutralizer':
-    #         # payload example: {'type':'neutralizer','action':'tag','status':211,'items':{...},'message':...}
-    #         action = payload.get('action')
-    #         items = payload.get('items') or {}
-    #         barcode = items.get('barcode') if isinstance(items, dict) else None
-    #         Item = env['paytag.item'].sudo()
-    #         if barcode:
-    #             found = Item.search([('barcode', '=', barcode)], limit=1)
-    #             if found:
-    #                 found.sudo().write({'status': 'neutralized'})
-    #         _logger.info("Neutralizer action processed: %s, barcode=%s", action, barcode)
-
-    #     # 3) Info / status messages
-    #     elif payload.get('type') == 'info' or 'status' in payload:
-    #         _logger.info("Info/status from Paytag: %s", payload)
-
-    #     else:
-    #         _logger.debug("Unhandled payload: %s", payload)
-
-
-
-def _process_message(self, env, payload):
-    """
-    Parse payload and create/update session/items.
-    This will be executed inside a DB cursor context when invoked from the thread.
-    """
-    # 1) ACTION barcode
-    if payload.get('type') == 'barcode':
-        action = payload.get('action')
-        item = payload.get('item') or {}
-        rfid = item.get('rfid') or ''
-        barcode = item.get('barcode') or ''
+            _logger.exception("Failed to retry batch of %d payloads from %s", len(batch), machine_ip)
+            self._forget_active_session(machine_ip)
+            return False
+        if dropped:
+            metrics.INGEST_DROPPED.inc(dropped, machine=machine_ip)
+        return True
 
-        if not rfid and not barcode:
-            _logger.warning("Barcode message without rfid and barcode: %s", payload)
-            return
+    def _process_batch(self, env, payloads, machine_ip):
+        """
+        Apply payloads in arrival order. Consecutive ``barcode`` frames are
+        applied together with bulk reads and writes; any other frame is
+        handled on its own so it keeps its place relative to the scans.
+        """
+        run = []
+        for payload in payloads:
+            if payload.get('type') == 'barcode':
+                run.append(payload)
+                continue
+            if run:
+                with metrics.PROCESS_LATENCY.time(type='barcode'):
+                    self._apply_barcode_events(env, run, machine_ip)
+                run = []
+            with metrics.PROCESS_LATENCY.time(type=payload.get('type') or 'other'):
+                self._process_message(env, payload, machine_ip)
+        if run:
+            with metrics.PROCESS_LATENCY.time(type='barcode'):
+                self._apply_barcode_events(env, run, machine_ip)
+
+    @api.model
+    def replay_journal(self, start=None, end=None, machine_ip=None, realtime=False, speed=1.0, commit=False):
+        """
+        Feed the journaled frames between ``start`` and ``end`` (naive UTC
+        datetimes) back through ``_process_batch``, e.g. after a bug fix or
+        to measure ingestion offline.
+
+        At full speed consecutive frames of a machine are applied in
+        batches of ``paytag.ingest_batch_size``. With ``realtime`` the
+        original spacing of the frames, divided by ``speed``, is kept and
+        frames are batched over the ingestion window as they would have
+        been live.
+
+        The journal does not record sessions: frames are applied to the
+        session active *now* on their machine, one being created when there
+        is none, like live frames would be. Replay therefore runs in the
+        caller's transaction by default, to be inspected and rolled back;
+        only with ``commit`` is every batch committed on its own.
+
+        Return a dict with the number of frames and batches and the time
+        spent applying them.
+        """
+        journal = PaytagJournal(self.env.cr.dbname)
+        batch_size = PaytagWebsocketService._ingest_batch_size
+        window = PaytagWebsocketService._ingest_window
+        stats = {'frames': 0, 'batches': 0, 'process_seconds': 0.0}
+        batch = []
+        batch_machine = None
+        batch_ts = None
 
+        def flush():
+            started = time.monotonic()
+            self._process_batch(self.env, batch, batch_machine)
+            if commit:
+                self.env.cr.commit()
+            stats['process_seconds'] += time.monotonic() - started
+            stats['frames'] += len(batch)
+            stats['batches'] += 1
+            batch.clear()
+
+        replay_started = time.monotonic()
+        first_ts = None
+        for ts, frame_machine, frame in journal.read(start, end, machine_ip):
+            if realtime:
+                if first_ts is None:
+                    first_ts = ts
+                delay = (ts - first_ts) / speed - (time.monotonic() - replay_started)
+                if batch and (delay > 0 or ts - batch_ts > window):
+                    flush()
+                if delay > 0:
+                    time.sleep(delay)
+            if batch and (frame_machine != batch_machine or len(batch) >= batch_size):
+                flush()
+            if not batch:
+                batch_machine = frame_machine
+                batch_ts = ts
+            batch.append(frame)
+        if batch:
+            flush()
+        stats['elapsed_seconds'] = time.monotonic() - replay_started
+        stats['frames_per_second'] = stats['frames'] / stats['process_seconds'] if stats['process_seconds'] else 0.0
+        _logger.info("Replayed %d Paytag frames in %d batches: %s", stats['frames'], stats['batches'], stats)
+        return stats
+
+    # ------------- Active session cache -------------
+
+    @api.model
+    def _default_machine_ip(self):
+        """Machine used when a request or session does not name one."""
+        return next(iter(self._configured_machines()), '')
+
+    @api.model
+    def _remember_active_session(self, machine_ip, session_id, generation=None):
+        """
+        Cache ``session_id`` as the active session of ``machine_ip``, unless
+        ``generation`` is given and the machine's entry was forgotten since.
+        """
+        with PaytagWebsocketService._active_sessions_lock:
+            if generation is not None \
+                    and PaytagWebsocketService._active_session_generations.get(machine_ip or '', 0) != generation:
+                return
+            PaytagWebsocketService._active_sessions[machine_ip or ''] = (session_id, time.monotonic())
+
+    def _remember_active_session_after_commit(self, cr, machine_ip, session_id):
+        """
+        Cache ``session_id`` once ``cr`` commits. A forget of the machine in
+        between, e.g. the session being closed in the same transaction,
+        cancels it.
+        """
+        with PaytagWebsocketService._active_sessions_lock:
+            generation = PaytagWebsocketService._active_session_generations.get(machine_ip or '', 0)
+        cr.postcommit.add(partial(self._remember_active_session, machine_ip, session_id, generation))
+
+    @api.model
+    def _forget_active_session(self, machine_ip, session_id=None):
+        """Drop the cached session of ``machine_ip`` (only if it is ``session_id`` when given)."""
+        with PaytagWebsocketService._active_sessions_lock:
+            generations = PaytagWebsocketService._active_session_generations
+            generations[machine_ip or ''] = generations.get(machine_ip or '', 0) + 1
+            entry = PaytagWebsocketService._active_sessions.get(machine_ip or '')
+            if entry and (session_id is None or entry[0] == session_id):
+                del PaytagWebsocketService._active_sessions[machine_ip or '']
+
+    def _get_active_session(self, env, machine_ip=None, create=True):
+        """
+        Return the active session of a machine, creating one if needed.
+
+        The cached session is confirmed by id on every lookup, since /start
+        and /stop are usually served by another worker whose cache updates
+        never reach this one; the table is only searched when the cache is
+        empty or the cached session is no longer active. The lock makes
+        concurrent callers of this worker share one session.
+        """
         Session = env['paytag.session'].sudo()
+        if not machine_ip:
+            machine_ip = env['paytag.websocket.service']._default_machine_ip()
+        with PaytagWebsocketService._active_sessions_lock:
+            entry = PaytagWebsocketService._active_sessions.get(machine_ip)
+            session = Session
+            if entry:
+                session = Session.search([('id', '=', entry[0]), ('state', 'in', list(ACTIVE_SESSION_STATES))])
+                if not session:
+                    self._forget_active_session(machine_ip, entry[0])
+            if not session:
+                # Find active session or create one (simple logic: last session not done)
+                session = Session.search(
+                    [('state', 'in', list(ACTIVE_SESSION_STATES)),
+                     ('machine_ip', 'in', [machine_ip, False])],
+                    limit=1,
+                    order='start_time desc'
+                )
+            if not session:
+                if not create:
+                    return session
+                session = Session.create({
+                    'name': f"session-{datetime.now().strftime('%Y%m%d%H%M%S')}",
+                    'state': 'scanning',
+                    'machine_ip': machine_ip,
+                })
+            elif session.id == (entry and entry[0]):
+                # still active: refresh the entry without waiting for a commit
+                self._remember_active_session(machine_ip, session.id)
+            else:
+                # only share the session with other callers once it is committed
+                self._remember_active_session_after_commit(env.cr, machine_ip, session.id)
+            return session
+
+    def _apply_barcode_events(self, env, events, machine_ip=None):
+        """
+        Apply a run of ``barcode`` frames to the active session of a machine.
+
+        Events are collapsed per RFID (or per barcode for untagged items) so
+        only the last action for each tag is written, then the whole run is
+        upserted with one statement per tag key.
+        """
         Item = env['paytag.item'].sudo()
         Product = env['product.product'].sudo()
 
-        # Find active session or create one (simple logic: last session not done)
-        session = Session.search(
-            [('state', 'in', ['waiting', 'scanning'])],
+        # Collapse events per tag; dict order keeps first-seen order
+        latest = {}
+        for payload in events:
+            item = payload.get('item') or {}
+            rfid = item.get('rfid') or ''
+            barcode = item.get('barcode') or ''
+            if not rfid and not barcode:
+                _logger.warning("Barcode message without rfid and barcode: %s", payload)
+                continue
+            key = ('rfid', rfid) if rfid else ('barcode', barcode)
+            latest[key] = {
+                'rfid': rfid,
+                'barcode': barcode,
+                'status': 'added' if payload.get('action') == 'added' else 'removed',
+            }
+        if not latest:
+            return
+
+        session = self._get_active_session(env, machine_ip)
+
+        # 🔍 Resolve all barcodes to products through the per-worker index
+        barcodes = {ev['barcode'] for ev in latest.values() if ev['barcode']}
+        product_ids = Product._paytag_resolve_codes(barcodes)
+        # 📦 Attach product to item if found
+        for ev in latest.values():
+            ev['product_id'] = product_ids.get(ev['barcode'])
+
+        created, changed = Item._upsert_tag_events(session.id, list(latest.values()))
+        changed._notify_item_events('updated')
+        created._notify_item_events('created')
+
+        # Update session state; a session closed meanwhile is never reopened
+        if session.state == 'waiting':
+            session.write({'state': 'scanning'})
+
+        _logger.info(
+            "Processed %d barcode events for session %s: %d changed, %d created",
+            len(events), session.id, len(changed), len(created),
+        )
+
+    def _neutralizer_session(self, env, payload, machine_ip=None):
+        """
+        Return the session a neutralizer frame belongs to: the one of the
+        ``transaction_number`` it carries, else the latest session of the
+        machine that can still be neutralized.
+        """
+        Session = env['paytag.session'].sudo()
+        items = payload.get('items')
+        transaction_number = payload.get('transaction_number') or (
+            items.get('transaction_number') if isinstance(items, dict) else None)
+        if transaction_number:
+            return Session.search([('transaction_number', '=', transaction_number)], limit=1, order='id desc')
+        return Session.search(
+            [('state', 'in', list(NEUTRALIZER_SESSION_STATES)),
+             ('machine_ip', 'in', [machine_ip or self._default_machine_ip(), False])],
             limit=1,
             order='start_time desc'
         )
+
+    def _apply_neutralizer_event(self, env, payload, machine_ip=None):
+        """
+        Mark the items of a neutralizer frame as neutralized.
+
+        ``items`` is one item dict or a list of them; each entry matches the
+        item with its RFID, or the first not yet neutralized item with its
+        barcode (tagged or not), within the frame's session. Entries with an
+        RFID claim their items first. All matches are written at once.
+        """
+        action = payload.get('action')
+        entries = payload.get('items') or []
+        if isinstance(entries, dict):
+            entries = [entries]
+        entries = [entry for entry in entries if isinstance(entry, dict)]
+        rfids = {entry['rfid'] for entry in entries if entry.get('rfid')}
+        barcodes = {entry['barcode'] for entry in entries if entry.get('barcode') and not entry.get('rfid')}
+        if not rfids and not barcodes:
+            _logger.info("Neutralizer action %s without items", action)
+            return
+
+        session = self._neutralizer_session(env, payload, machine_ip)
         if not session:
-            session = Session.create({
-                'name': f"session-{datetime.now().strftime('%Y%m%d%H%M%S')}",
-                'state': 'scanning',
-            })
+            _logger.warning("Neutralizer action %s without a session: %s", action, payload)
+            return
 
-        # 🔍 Try to find product by barcode
-        product = False
-        if barcode:
-            product = Product.search([('barcode', '=', barcode)], limit=1)
-
-        # Create or update item
-        if rfid:
-            existing = Item.search([
-                ('rfid', '=', rfid),
-                ('session_id', '=', session.id)
-            ], limit=1)
+        Item = env['paytag.item'].sudo()
+        domain = [('session_id', '=', session.id), ('status', '!=', 'neutralized')]
+        if rfids and barcodes:
+            domain += ['|', ('rfid', 'in', list(rfids)), ('barcode', 'in', list(barcodes))]
+        elif rfids:
+            domain += [('rfid', 'in', list(rfids))]
         else:
-            existing = Item.search([
-                ('barcode', '=', barcode),
-                ('session_id', '=', session.id)
-            ], limit=1)
-
-        vals = {
-            'rfid': rfid,
-            'barcode': barcode,
-            'status': 'added' if action == 'added' else 'removed',
-            'session_id': session.id,
-            'last_seen': fields.Datetime.now(),
-        }
+            domain += [('barcode', 'in', list(barcodes))]
+        by_rfid = {}
+        by_barcode = {}
+        for item in Item.search(domain, order='id'):
+            if item.rfid:
+                by_rfid.setdefault(item.rfid, item)
+            if item.barcode:
+                by_barcode.setdefault(item.barcode, []).append(item)
 
-        # 📦 Attach product to item if found
-        if product:
-            vals['product_id'] = product.id
+        found = Item.browse()
+        for entry in entries:
+            item = by_rfid.pop(entry['rfid'], None) if entry.get('rfid') else None
+            if item:
+                found |= item
+        for entry in entries:
+            if entry.get('rfid'):
+                continue
+            candidates = by_barcode.get(entry.get('barcode')) or []
+            while candidates and candidates[0] in found:
+                candidates.pop(0)
+            if candidates:
+                found |= candidates.pop(0)
+        if found:
+            found.write({'status': 'neutralized'})
+            found._notify_item_events('updated')
+        _logger.info(
+            "Neutralizer action %s processed for session %s: %d of %d items neutralized",
+            action, session.id, len(found), len(entries),
+        )
 
-        if existing:
-            existing.write(vals)
-        else:
-            vals['first_seen'] = fields.Datetime.now()
-            Item.create(vals)
+    @staticmethod
+    def _is_snapshot(payload):
+        """Whether ``payload`` is the device's full basket answering a get_items."""
+        return payload.get('command') == 'get_items' and isinstance(payload.get('items'), list)
 
-        # Update session state
-        if session.state != 'scanning':
-            session.sudo().write({'state': 'scanning'})
+    def _reconcile_snapshot(self, env, payload, machine_ip=None):
+        """
+        Bring the active session of a machine in line with the full basket
+        the device reported, in the current transaction.
 
+        Device items and session items are matched by RFID (or barcode for
+        untagged items) in one pass: items missing from the session are
+        created, present items go back to ``added`` and get their barcode
+        and product refreshed, and ``added`` items the device no longer sees
+        become ``removed``. Paid, unpaid and neutralized items keep their
+        status. Changes are applied with one upsert and one bulk write.
+        """
+        session = self._get_active_session(env, machine_ip, create=False)
+        if not session:
+            _logger.info("Paytag snapshot from %s without an active session, ignored", machine_ip)
+            return
+        Item = env['paytag.item'].sudo()
+        Product = env['product.product'].sudo()
+
+        present = {}
+        for item in payload['items']:
+            if not isinstance(item, dict):
+                continue
+            rfid = item.get('rfid') or ''
+            barcode = item.get('barcode') or ''
+            if rfid or barcode:
+                present[('rfid', rfid) if rfid else ('barcode', barcode)] = item
+        current = {}
+        for row in Item.search_read([('session_id', '=', session.id)],
+                                    ['rfid', 'barcode', 'status', 'product_id', 'is_ht'], order='id'):
+            key = ('rfid', row['rfid']) if row['rfid'] else ('barcode', row['barcode'] or '')
+            current.setdefault(key, row)
+
+        product_ids = Product._paytag_resolve_codes(
+            {item['barcode'] for item in present.values() if item.get('barcode')})
+        events = []
+        for key, item in present.items():
+            row = current.get(key)
+            barcode = item.get('barcode') or (row['barcode'] if row else '') or ''
+            product_id = product_ids.get(barcode)
+            is_ht = item.get('is_ht')
+            if row is None:
+                events.append({'rfid': item.get('rfid') or '', 'barcode': barcode,
+                               'status': 'added', 'product_id': product_id, 'is_ht': is_ht})
+                continue
+            status = 'added' if row['status'] in PRESENCE_STATUSES else row['status']
+            if status != row['status'] or barcode != (row['barcode'] or '') \
+                    or (product_id and product_id != (row['product_id'] and row['product_id'][0])) \
+                    or (is_ht is not None and bool(is_ht) != row['is_ht']):
+                events.append({'rfid': row['rfid'] or '', 'barcode': barcode,
+                               'status': status, 'product_id': product_id, 'is_ht': is_ht})
+        gone = Item.browse([
+            row['id'] for key, row in current.items()
+            if key not in present and row['status'] == 'added'
+        ])
+
+        created = changed = Item
+        if events:
+            created, changed = Item._upsert_tag_events(session.id, events)
+        if gone:
+            gone.write({'status': 'removed'})
+        (changed | gone)._notify_item_events('updated')
+        created._notify_item_events('created')
         _logger.info(
-            "Processed barcode action: %s (rfid=%s barcode=%s, product_id=%s)",
-            action, rfid, barcode, product.id if product else None
+            "Reconciled Paytag snapshot of %d items with session %s: %d created, %d changed, %d removed",
+            len(present), session.id, len(created), len(changed), len(gone),
         )
 
-    # 2) Neutralizer type action
-    elif payload.get('type') == 'neutralizer':
-        # payload example: {'type':'neutralizer','action':'tag','status':211,'items':{...},'message':...}
-        action = payload.get('action')
-        items = payload.get('items') or {}
-        barcode = items.get('barcode') if isinstance(items, dict) else None
-        Item = env['paytag.item'].sudo()
-        if barcode:
-            found = Item.search([('barcode', '=', barcode)], limit=1)
-            if found:
-                found.sudo().write({'status': 'neutralized'})
-        _logger.info("Neutralizer action processed: %s, barcode=%s", action, barcode)
+    def _process_message(self, env, payload, machine_ip=None):
+        """
+        Parse payload and create/update session/items.
+        This will be executed inside a DB cursor context when invoked from the thread.
+        """
+        if payload.get('request_code'):
+            # a reply to a neutralization chunk dispatches the next ones
+            env['paytag.neutralize.line'].sudo()._neutralize_reply(payload)
+
+        # 0) Full basket sent in reply to get_items
+        if self._is_snapshot(payload):
+            self._reconcile_snapshot(env, payload, machine_ip)
 
-    # 3) Info / status messages
-    elif payload.get('type') == 'info' or 'status' in payload:
-        _logger.info("Info/status from Paytag: %s", payload)
+        # 1) ACTION barcode
+        elif payload.get('type') == 'barcode':
+            self._apply_barcode_events(env, [payload], machine_ip)
 
-    else:
-        _logger.debug("Unhandled payload: %s", payload)
+        # 2) Neutralizer type action
+        elif payload.get('type') == 'neutralizer':
+            # payload example: {'type':'neutralizer','action':'tag','status':211,'items':{...},'message':...}
+            self._apply_neutralizer_event(env, payload, machine_ip)
 
+        # 3) Info / status messages
+        elif payload.get('type') == 'info' or 'status' in payload:
+            _logger.info("Info/status from Paytag: %s", payload)
+
+        else:
+            _logger.debug("Unhandled payload: %s", payload)
+
+    # ------------- Commands -------------
+
+    def _resolve_reply(self, machine_ip, payload):
+        """Hand a frame of ``machine_ip`` to the caller waiting on its ``request_code``, if any."""
+        request_code = payload.get('request_code')
+        if not request_code:
+            return False
+        with PaytagWebsocketService._pending_replies_lock:
+            fut = PaytagWebsocketService._pending_replies.pop((machine_ip, request_code), None)
+        if fut is None or fut.done():
+            return False
+        fut.set_result(payload)
+        _logger.debug("Matched Paytag reply for request %s", request_code)
+        return True
 
     @api.model
-    def send_command(self, command_dict):
+    def send_command(self, command_dict, wait_ms=None, machine_ip=None):
         """
-        Queue a command to be sent to the Paytag device.
+        Queue a command to be sent to a Paytag device (the default machine
+        unless ``machine_ip`` is given, which must be one of ``paytag.machines``
+        or PaytagUnknownMachine is raised).
         Example command_dict: {"command":"start", "request_code":"abc", ...}
+
+        Without ``wait_ms`` return True once the command is queued. With
+        ``wait_ms`` block up to that many milliseconds for the device frame
+        carrying the same ``request_code`` and return it, or None when the
+        command could not be queued or the device did not answer in time.
+
+        Queuing never blocks: PaytagQueueFull is raised when the machine
+        already has ``paytag.command_queue_size`` commands waiting. A
+        get_items merged into one already queued gets that one's reply.
         """
-        if PaytagWebsocketService._loop and PaytagWebsocketService._send_queue:
-            try:
-                # Use loop.call_soon_threadsafe to schedule put in queue
-                fut = asyncio.run_coroutine_threadsafe(PaytagWebsocketService._send_queue.put(command_dict), PaytagWebsocketService._loop)
-                fut.result(timeout=2)
-                _logger.debug("Queued command for Paytag: %s", command_dict)
-                return True
-            except Exception as e:
-                _logger.exception("Failed to queue command: %s", e)
-                return False
-        else:
-            _logger.warning("Websocket loop not running; cannot send command.")
-            return False
+        machines = self._configured_machines()
+        machine_ip = machine_ip or next(iter(machines), '')
+        if machine_ip not in machines:
+            raise PaytagUnknownMachine(machine_ip)
+        if not (PaytagWebsocketService._thread and PaytagWebsocketService._thread.is_alive()):
+            # another worker owns the devices
+            return self._forward_command(command_dict, machine_ip, wait_ms=wait_ms)
+
+        request_code = command_dict.get('request_code')
+        key = (machine_ip, request_code)
+        waiter = None
+        if wait_ms and request_code:
+            waiter = concurrent.futures.Future()
+            with PaytagWebsocketService._pending_replies_lock:
+                PaytagWebsocketService._pending_replies[key] = waiter
+
+        status, queued_code = self._get_machine(machine_ip, machines[machine_ip]).commands.put(command_dict)
+        _logger.debug("Command for Paytag %s %s: %s", machine_ip, status, command_dict)
+        if status == 'full':
+            if waiter is not None:
+                with PaytagWebsocketService._pending_replies_lock:
+                    PaytagWebsocketService._pending_replies.pop(key, None)
+            _logger.warning("Paytag %s command queue is full; rejected %s", machine_ip, command_dict.get('command'))
+            raise PaytagQueueFull(machine_ip)
+
+        if waiter is None:
+            return True
+        if queued_code != request_code:
+            # merged into a queued get_items: wait for that one's reply instead
+            with PaytagWebsocketService._pending_replies_lock:
+                PaytagWebsocketService._pending_replies.pop(key, None)
+                key = (machine_ip, queued_code)
+                waiter = PaytagWebsocketService._pending_replies.setdefault(key, waiter)
+            request_code = queued_code
+        try:
+            return waiter.result(timeout=wait_ms / 1000.0)
+        except concurrent.futures.TimeoutError:
+            _logger.info("No Paytag reply for request %s within %d ms", request_code, wait_ms)
+        finally:
+            with PaytagWebsocketService._pending_replies_lock:
+                if PaytagWebsocketService._pending_replies.get(key) is waiter:
+                    del PaytagWebsocketService._pending_replies[key]
+        return None
+
+    @api.model
+    def send_commands(self, commands, wait_ms=None):
+        """
+        Queue ``(machine_ip, command)`` pairs in order and then, with
+        ``wait_ms``, wait up to that long for the device's reply to the first
+        one, so the commands after it are queued before the wait. Meant for
+        commands that are never merged, like neutralization chunks.
+
+        Return ``(reply, rejected)`` where ``rejected`` lists the request
+        codes that could not be queued (unknown machine or full queue).
+        """
+        machines = self._configured_machines()
+        default_ip = next(iter(machines), '')
+        rejected = []
+        accepted = []
+        for machine_ip, command in commands:
+            machine_ip = machine_ip or default_ip
+            if machine_ip in machines:
+                accepted.append((machine_ip, command))
+            else:
+                _logger.warning("Paytag command %s for unknown machine %r", command.get('request_code'), machine_ip)
+                rejected.append(command.get('request_code'))
+        if not accepted:
+            return None, rejected
+        if not (PaytagWebsocketService._thread and PaytagWebsocketService._thread.is_alive()):
+            # another worker owns the devices
+            reply, statuses = self._forward_commands(accepted, wait_ms=wait_ms)
+            rejected += [command.get('request_code') for (_ip, command), status in zip(accepted, statuses)
+                         if status not in ('queued', 'coalesced')]
+            return reply, rejected
+
+        request_code = accepted[0][1].get('request_code')
+        key = (accepted[0][0], request_code)
+        waiter = None
+        if wait_ms and request_code:
+            waiter = concurrent.futures.Future()
+            with PaytagWebsocketService._pending_replies_lock:
+                PaytagWebsocketService._pending_replies[key] = waiter
+        for machine_ip, command in accepted:
+            status = self._get_machine(machine_ip, machines[machine_ip]).commands.put(command)[0]
+            _logger.debug("Command for Paytag %s %s: %s", machine_ip, status, command)
+            if status == 'full':
+                _logger.warning("Paytag %s command queue is full; rejected %s", machine_ip, command.get('command'))
+                rejected.append(command.get('request_code'))
+        if waiter is None:
+            return None, rejected
+        try:
+            if request_code not in rejected:
+                return waiter.result(timeout=wait_ms / 1000.0), rejected
+        except concurrent.futures.TimeoutError:
+            _logger.info("No Paytag reply for request %s within %d ms", request_code, wait_ms)
+        finally:
+            with PaytagWebsocketService._pending_replies_lock:
+                if PaytagWebsocketService._pending_replies.get(key) is waiter:
+                    del PaytagWebsocketService._pending_replies[key]
+        return None, rejected
 
     @api.model
     def stop_service(self):
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from odoo import models, api
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_PRODUCT_INDEX_SIZE = 50000
+PRODUCT_INDEX_SEQUENCE = 'paytag_product_index_seq'
+# Fields whose change can alter the result of a code lookup
+PRODUCT_INDEX_FIELDS = {'barcode', 'default_code', 'active'}
+# Bumped when a field served with the items changes, so their cached responses are revalidated
+PRODUCT_VERSION_SEQUENCE = 'paytag_product_version_seq'
+PRODUCT_VERSION_FIELDS = {'name', 'default_code', 'lst_price', 'list_price'}
+
+
+class PaytagProductIndex(object):
+    """
+    Per-worker LRU map of ``(field, code) -> product id`` used to resolve
+    scanned tags without a SQL round trip. Unknown codes are cached as False
+    so repeated reads of a tag without product stay cheap too.
+    """
+    # Minimum delay between two checks of the cross-worker sequence
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.sequence = None
+        self.checked_at = 0.0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_many(self, keys):
+        """Return ``(found, missing)`` for the given keys."""
+        found = {}
+        missing = []
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+                else:
+                    missing.append(key)
+        return found, missing
+
+    def put_many(self, mapping):
+        with self.lock:
+            for key, value in mapping.items():
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+# One index per database served by this worker
+_product_indexes = {}
+_product_indexes_lock = threading.Lock()
+
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    def init(self):
+        super().init()
+        self.env.cr.execute(f"CREATE SEQUENCE IF NOT EXISTS {PRODUCT_INDEX_SEQUENCE}")
+        self.env.cr.execute(f"CREATE SEQUENCE IF NOT EXISTS {PRODUCT_VERSION_SEQUENCE}")
+
+    # ------------- Index access -------------
+
+    @api.model
+    def _paytag_product_index(self):
+        dbname = self.env.cr.dbname
+        index = _product_indexes.get(dbname)
+        if index is None:
+            with _product_indexes_lock:
+                index = _product_indexes.get(dbname)
+                if index is None:
+                    size = int(self.env['ir.config_parameter'].sudo().get_param(
+                        'paytag.product_index_size', DEFAULT_PRODUCT_INDEX_SIZE))
+                    index = _product_indexes[dbname] = PaytagProductIndex(max(1, size))
+        self._paytag_check_product_index(index)
+        return index
+
+    @api.model
+    def _paytag_check_product_index(self, index):
+        """Drop the index if another worker changed product codes since last check."""
+        now = time.monotonic()
+        if now - index.checked_at < index.CHECK_INTERVAL:
+            return
+        self.env.cr.execute(f"SELECT last_value FROM {PRODUCT_INDEX_SEQUENCE}")
+        sequence = self.env.cr.fetchone()[0]
+        with index.lock:
+            if index.sequence != sequence:
+                if index.sequence is not None:
+                    _logger.debug("Paytag product index invalidated by another worker")
+                index.entries.clear()
+                index.sequence = sequence
+            index.checked_at = now
+
+    @api.model
+    def _paytag_warm_product_index(self):
+        """Load every product barcode into the index (bounded by its size)."""
+        index = self._paytag_product_index()
+        products = self.sudo().search_read([('barcode', '!=', False)], ['barcode'], limit=index.size, order='id desc')
+        index.put_many({('barcode', p['barcode']): p['id'] for p in reversed(products)})
+        _logger.info("Warmed Paytag product index with %d barcodes", len(products))
+        return len(products)
+
+    @api.model
+    def _paytag_resolve_codes(self, codes, match_default_code=False):
+        """
+        Return ``{code: product_id}`` for the codes that match a product
+        barcode, falling back to ``default_code`` when asked to. Codes
+        without product are left out of the result.
+        """
+        codes = {code for code in codes if code}
+        if not codes:
+            return {}
+        index = self._paytag_product_index()
+        fields_order = ['barcode', 'default_code'] if match_default_code else ['barcode']
+        keys = [(field, code) for field in fields_order for code in codes]
+        found, missing = index.get_many(keys)
+
+        if missing:
+            loaded = dict.fromkeys(missing, False)
+            Product = self.sudo().with_context(active_test=True)
+            for field in fields_order:
+                field_codes = [code for f, code in missing if f == field]
+                if not field_codes:
+                    continue
+                for product in Product.search_read([(field, 'in', field_codes)], [field]):
+                    key = (field, product[field])
+                    # keep the first match in the model's default order
+                    if not loaded.get(key):
+                        loaded[key] = product['id']
+            index.put_many(loaded)
+            found.update(loaded)
+
+        result = {}
+        for field in fields_order:
+            for code in codes:
+                if code not in result and found.get((field, code)):
+                    result[code] = found[(field, code)]
+        return result
+
+    # ------------- Invalidation -------------
+
+    def _paytag_invalidate_product_index(self):
+        """Clear the local index now and signal other workers after commit."""
+        index = _product_indexes.get(self.env.cr.dbname)
+        if index is not None:
+            index.clear()
+        registry = self.env.registry
+
+        @self.env.cr.postcommit.add
+        def signal_change():
+            if index is not None:
+                index.clear()
+            with registry.cursor() as cr:
+                cr.execute(f"SELECT nextval('{PRODUCT_INDEX_SEQUENCE}')")
+                sequence = cr.fetchone()[0]
+            if index is not None:
+                with index.lock:
+                    index.sequence = sequence
+
+    @api.model
+    def _paytag_product_version(self):
+        """Current product version, part of the ETag of ``/api/paytag/items``."""
+        self.env.cr.execute(f"SELECT last_value FROM {PRODUCT_VERSION_SEQUENCE}")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _paytag_bump_product_version(self):
+        """
+        Move the product version once the transaction commits: bumped
+        earlier, a response built from the old values could be cached
+        under the new version.
+        """
+        registry = self.env.registry
+
+        @self.env.cr.postcommit.add
+        def bump_version():
+            with registry.cursor() as cr:
+                cr.execute(f"SELECT nextval('{PRODUCT_VERSION_SEQUENCE}')")
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        products = super().create(vals_list)
+        if any(vals.get('barcode') or vals.get('default_code') for vals in vals_list):
+            products._paytag_invalidate_product_index()
+        return products
+
+    def write(self, vals):
+        res = super().write(vals)
+        if PRODUCT_INDEX_FIELDS.intersection(vals):
+            self._paytag_invalidate_product_index()
+        if PRODUCT_VERSION_FIELDS.intersection(vals):
+            self._paytag_bump_product_version()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self._paytag_invalidate_product_index()
+        return res
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from odoo import models
+
+from .product_product import PRODUCT_VERSION_FIELDS
+
+
+class ProductTemplate(models.Model):
+    _inherit = 'product.template'
+
+    def write(self, vals):
+        res = super().write(vals)
+        # name and list price are usually edited on the template
+        if PRODUCT_VERSION_FIELDS.intersection(vals):
+            self.env['product.product']._paytag_bump_product_version()
+        return res
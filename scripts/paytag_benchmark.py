@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the Paytag integration against a running Odoo.
+
+``ingest`` serves a fake device (see paytag_fake_device.py), lets the
+Odoo websocket service connect to it and reports, from the
+``paytag_items`` notifications PostgreSQL delivers on commit, the
+frame-to-commit latency percentiles and sustained events/sec::
+
+    # Odoo side: paytag.machines = ws://127.0.0.1:8765/ws
+    python3 paytag_benchmark.py ingest --dsn "dbname=odoo" --rate 500 --duration 60
+
+``rest`` hammers one REST endpoint with concurrent clients and reports
+requests/sec, status codes and latency percentiles::
+
+    python3 paytag_benchmark.py rest --url "http://localhost:8069/api/paytag/items?session_id=1" \\
+        --concurrency 20 --duration 30
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+
+import aiohttp
+import psycopg2
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from paytag_fake_device import FakePaytagDevice  # noqa: E402
+
+_logger = logging.getLogger("paytag.benchmark")
+
+ITEM_EVENTS_CHANNEL = "paytag_items"
+
+
+def percentiles(samples, points=(50, 90, 95, 99)):
+    """Nearest-rank percentiles of ``samples`` (plus max), in milliseconds."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    result = {f"p{point}": ordered[min(len(ordered) - 1, int(len(ordered) * point / 100.0))] * 1000.0
+              for point in points}
+    result["max"] = ordered[-1] * 1000.0
+    return result
+
+
+def report(title, values):
+    print(f"\n== {title}")
+    for key, value in values.items():
+        if isinstance(value, float):
+            print(f"{key:>24}: {value:,.2f}")
+        elif isinstance(value, dict):
+            print(f"{key:>24}: " + ", ".join(
+                f"{k}={v:,.2f}" if isinstance(v, float) else f"{k}={v}" for k, v in value.items()))
+        else:
+            print(f"{key:>24}: {value}")
+
+
+async def bench_ingest(args):
+    device = FakePaytagDevice(
+        rate=args.rate, basket_size=args.basket_size, removal_ratio=args.removal_ratio,
+        trace=args.trace, speed=args.speed, autostart=True, info_interval=0, seed=args.seed,
+    )
+    runner = web.AppRunner(device.app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+
+    latencies = []
+    committed = 0
+    conn = psycopg2.connect(args.dsn)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    conn.cursor().execute(f"LISTEN {ITEM_EVENTS_CHANNEL}")
+
+    def on_notify():
+        nonlocal committed
+        now = time.time()
+        conn.poll()
+        while conn.notifies:
+            for event in json.loads(conn.notifies.pop(0).payload):
+                sent_at = device.sent_at.pop(event.get("rfid") or event.get("barcode"), None)
+                if sent_at is not None:
+                    latencies.append(now - sent_at)
+                    committed += 1
+
+    loop = asyncio.get_running_loop()
+    loop.add_reader(conn, on_notify)
+    try:
+        print(f"Waiting up to {args.connect_timeout}s for the Odoo websocket service on {args.host}:{args.port}...")
+        deadline = loop.time() + args.connect_timeout
+        while not device.clients:
+            if loop.time() > deadline:
+                raise SystemExit("The Odoo websocket service did not connect, check paytag.machines")
+            await asyncio.sleep(0.2)
+        started = time.monotonic()
+        await asyncio.sleep(args.duration)
+        sent = device.frames_sent
+        elapsed = time.monotonic() - started
+        for ws in list(device.clients):
+            await ws.close()
+        # let the last batches commit
+        await asyncio.sleep(args.drain)
+    finally:
+        loop.remove_reader(conn)
+        conn.close()
+        await runner.cleanup()
+
+    report("Ingestion", {
+        "duration_s": elapsed,
+        "frames_sent": sent,
+        "events_committed": committed,
+        "sent_per_s": sent / elapsed,
+        "committed_per_s": committed / elapsed,
+        "uncommitted": len(device.sent_at),
+        "frame_to_commit_ms": percentiles(latencies),
+    })
+
+
+async def bench_rest(args):
+    latencies = []
+    statuses = Counter()
+    body = args.body.encode("utf-8") if args.body else None
+    headers = {"Content-Type": "application/json"} if body else {}
+    deadline = time.monotonic() + args.duration
+
+    async def client(session):
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                async with session.request(args.method, args.url, data=body, headers=headers) as response:
+                    await response.read()
+                    statuses[response.status] += 1
+            except aiohttp.ClientError as exc:
+                statuses[type(exc).__name__] += 1
+                continue
+            latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(client(session) for _ in range(args.concurrency)))
+    elapsed = time.monotonic() - started
+
+    report(f"{args.method} {args.url}", {
+        "duration_s": elapsed,
+        "concurrency": args.concurrency,
+        "requests": sum(statuses.values()),
+        "requests_per_s": len(latencies) / elapsed,
+        "statuses": dict(statuses),
+        "latency_ms": percentiles(latencies),
+    })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="benchmark", required=True)
+
+    ingest = commands.add_parser("ingest", help="frame-to-commit latency and events/sec of the receiver")
+    ingest.add_argument("--dsn", required=True, help="libpq connection string of the Odoo database")
+    ingest.add_argument("--host", default="127.0.0.1")
+    ingest.add_argument("--port", type=int, default=8765)
+    ingest.add_argument("--rate", type=float, default=200.0, help="frames per second (0: unthrottled)")
+    ingest.add_argument("--basket-size", type=int, default=20)
+    ingest.add_argument("--removal-ratio", type=float, default=0.0)
+    ingest.add_argument("--trace", help="journal file or JSON lines of frames to replay")
+    ingest.add_argument("--speed", type=float, default=1.0)
+    ingest.add_argument("--seed", type=int)
+    ingest.add_argument("--duration", type=float, default=30.0)
+    ingest.add_argument("--drain", type=float, default=5.0, help="seconds to wait for the last commits")
+    ingest.add_argument("--connect-timeout", type=float, default=90.0)
+
+    rest = commands.add_parser("rest", help="requests/sec and latency of a REST endpoint")
+    rest.add_argument("--url", required=True)
+    rest.add_argument("--method", default="GET")
+    rest.add_argument("--body", help="JSON body sent with every request")
+    rest.add_argument("--concurrency", type=int, default=10)
+    rest.add_argument("--duration", type=float, default=30.0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    benchmark = bench_ingest if args.benchmark == "ingest" else bench_rest
+    asyncio.run(benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
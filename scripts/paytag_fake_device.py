@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for a Paytag device, to exercise PaytagWebsocketService
+without hardware.
+
+Serves ``ws://<host>:<port>/ws`` and speaks the device protocol:
+
+* answers ``start``, ``get_items``, ``neutralize`` and ``stop`` commands
+  with a frame carrying their ``request_code``;
+* sends ``barcode`` frames for the items of synthetic baskets, or of a
+  recorded trace, while a session is started;
+* sends one ``neutralizer`` frame per neutralized barcode and periodic
+  ``info`` frames.
+
+Every ``barcode`` frame carries ``sent_at`` (epoch seconds) so latency can
+be measured end to end, see paytag_benchmark.py.
+
+Examples::
+
+    # point Odoo at it: paytag.machines = ws://127.0.0.1:8765/ws
+    python3 paytag_fake_device.py --rate 200 --basket-size 40
+    python3 paytag_fake_device.py --trace frames-20260101-083000123456-4242.jsonl.gz --speed 10
+"""
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import logging
+import random
+import time
+import zlib
+
+from aiohttp import web, WSMsgType
+
+_logger = logging.getLogger("paytag.fake_device")
+
+
+def synthetic_trace(basket_size=20, removal_ratio=0.0, barcodes=None, seed=None):
+    """
+    Endless ``barcode`` frames: baskets of ``basket_size`` tagged items,
+    each basket added item by item, ``removal_ratio`` of them removed again.
+    """
+    rng = random.Random(seed)
+    barcodes = barcodes or [f"BENCH{index:06d}" for index in range(1000)]
+    tags = itertools.count(1)
+    while True:
+        basket = [(f"RFID{next(tags):010d}", rng.choice(barcodes)) for _ in range(basket_size)]
+        for rfid, barcode in basket:
+            yield {"type": "barcode", "action": "added", "item": {"rfid": rfid, "barcode": barcode}}
+        for rfid, barcode in basket:
+            if rng.random() < removal_ratio:
+                yield {"type": "barcode", "action": "removed", "item": {"rfid": rfid, "barcode": barcode}}
+
+
+def recorded_trace(path):
+    """
+    ``(delay, frame)`` pairs from a Paytag journal file (gzip or plain
+    JSON lines of ``{"ts", "frame"}``) or from plain JSON lines of frames.
+    A journal torn by a crash is read up to the tear.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    previous = None
+    with opener(path, "rt", encoding="utf-8") as trace:
+        try:
+            for line in trace:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    _logger.warning("Skipping corrupt line of %s", path)
+                    continue
+                if "frame" in entry:
+                    ts, frame = entry.get("ts"), entry["frame"]
+                else:
+                    ts, frame = None, entry
+                delay = ts - previous if ts is not None and previous is not None else 0.0
+                previous = ts if ts is not None else previous
+                yield max(0.0, delay), frame
+        except (EOFError, OSError, zlib.error):
+            _logger.warning("%s ends with a truncated write", path)
+
+
+class FakePaytagDevice(object):
+    """One fake device; every websocket client gets its own session state."""
+
+    def __init__(self, rate=100.0, basket_size=20, removal_ratio=0.0, trace=None, speed=1.0,
+                 autostart=False, info_interval=30.0, seed=None):
+        self.rate = rate
+        self.basket_size = basket_size
+        self.removal_ratio = removal_ratio
+        self.trace = trace
+        self.speed = speed
+        self.autostart = autostart
+        self.info_interval = info_interval
+        self.seed = seed
+        self.frames_sent = 0
+        # rfid or barcode -> sent_at of the last frame about it, read by the benchmark
+        self.sent_at = {}
+        self.clients = set()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/ws", self.handle)
+        return app
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse(heartbeat=None)
+        await ws.prepare(request)
+        self.clients.add(ws)
+        state = {"items": {}, "streamer": None}
+        _logger.info("Client connected from %s", request.remote)
+        info = asyncio.ensure_future(self._send_info(ws))
+        if self.autostart:
+            state["streamer"] = asyncio.ensure_future(self._stream(ws, state))
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.TEXT:
+                    await self._handle_command(ws, state, json.loads(message.data))
+                elif message.type in (WSMsgType.CLOSED, WSMsgType.ERROR):
+                    break
+        finally:
+            info.cancel()
+            if state["streamer"]:
+                state["streamer"].cancel()
+            self.clients.discard(ws)
+            _logger.info("Client %s disconnected", request.remote)
+        return ws
+
+    async def _handle_command(self, ws, state, command):
+        name = command.get("command")
+        reply = {"type": "info", "request_code": command.get("request_code"), "command": name, "status": 200}
+        if name == "start":
+            state["items"].clear()
+            if not state["streamer"] or state["streamer"].done():
+                state["streamer"] = asyncio.ensure_future(self._stream(ws, state))
+            reply["message"] = "started"
+        elif name == "get_items":
+            reply["items"] = list(state["items"].values())
+        elif name == "neutralize":
+            barcodes = command.get("barcodes") or []
+            for barcode in barcodes:
+                await ws.send_json({
+                    "type": "neutralizer", "action": "tag", "status": 211,
+                    "transaction_number": command.get("transaction_number") or "",
+                    "items": {"barcode": barcode},
+                })
+            reply.update(success=True, neutralized=len(barcodes))
+        elif name == "stop":
+            if state["streamer"]:
+                state["streamer"].cancel()
+                state["streamer"] = None
+            reply["message"] = "stopped"
+        else:
+            reply.update(status=400, error=f"unknown command {name}")
+        await ws.send_json(reply)
+
+    async def _stream(self, ws, state):
+        """Send the trace frames at the configured rate (or recorded pace)."""
+        if self.trace:
+            frames = ((delay / self.speed, frame) for delay, frame in recorded_trace(self.trace))
+        else:
+            interval = 1.0 / self.rate if self.rate > 0 else 0.0
+            frames = ((interval, frame) for frame in synthetic_trace(
+                self.basket_size, self.removal_ratio, seed=self.seed))
+        loop = asyncio.get_running_loop()
+        next_at = loop.time()
+        for delay, frame in frames:
+            next_at += delay
+            wait = next_at - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if frame.get("type") == "barcode":
+                item = frame.get("item") or {}
+                key = item.get("rfid") or item.get("barcode")
+                frame = dict(frame, sent_at=time.time())
+                self.sent_at[key] = frame["sent_at"]
+                if frame.get("action") == "added":
+                    state["items"][key] = item
+                else:
+                    state["items"].pop(key, None)
+            await ws.send_json(frame)
+            self.frames_sent += 1
+        _logger.info("Trace finished after %d frames", self.frames_sent)
+
+    async def _send_info(self, ws):
+        while self.info_interval:
+            await asyncio.sleep(self.info_interval)
+            await ws.send_json({"type": "info", "status": 200, "message": "alive", "frames_sent": self.frames_sent})
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate", type=float, default=100.0, help="synthetic frames per second (0: unthrottled)")
+    parser.add_argument("--basket-size", type=int, default=20)
+    parser.add_argument("--removal-ratio", type=float, default=0.0)
+    parser.add_argument("--trace", help="journal file or JSON lines of frames to replay instead")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor of --trace")
+    parser.add_argument("--autostart", action="store_true", help="stream without waiting for a start command")
+    parser.add_argument("--info-interval", type=float, default=30.0)
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    device = FakePaytagDevice(
+        rate=args.rate, basket_size=args.basket_size, removal_ratio=args.removal_ratio, trace=args.trace,
+        speed=args.speed, autostart=args.autostart, info_interval=args.info_interval, seed=args.seed,
+    )
+    web.run_app(device.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()